@@ -16,7 +16,10 @@
 
 """Common utility functions."""
 
+import codecs
+import importlib
 import ipaddress
+import math
 import re
 import sys
 import time
@@ -24,17 +27,50 @@ import json
 import logging
 import socket
 import argparse
+import threading
+from collections import deque
 
 import jwt
 import requests
 
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase
+from requests.packages.urllib3.util.retry import Retry
 
 
 # Big-IP Address Pattern: <ipaddr>%<route_domain>
 ip_rd_re = re.compile(r'^([^%]*)%(\d+)$')
 
 
+def get_json_backends():
+    """Get the installed JSON backends, fastest first.
+
+    The stdlib json module is always available and is the last entry.
+    """
+    backends = []
+    for name in ['ujson', 'simplejson']:
+        try:
+            backends.append((name, importlib.import_module(name)))
+        except ImportError:
+            pass
+    backends.append(('json', json))
+    return backends
+
+
+# JSON codec used for all Marathon payloads
+json_backend_name, json_backend = get_json_backends()[0]
+
+
+def json_loads(data):
+    """Decode a JSON document with the selected JSON backend."""
+    return json_backend.loads(data)
+
+
+def json_dumps(obj):
+    """Encode an object as JSON with the selected JSON backend."""
+    return json_backend.dumps(obj)
+
+
 def parse_log_level(log_level_arg):
     """Parse the log level from the args.
 
@@ -97,6 +133,8 @@ class DCOSAuth(AuthBase):
         self.token = token
         self.verify = False
         self.auth_header = None
+        # Optional pooled session for the login endpoint
+        self.session = None
         self.expiry = 0
         if ca_cert:
             self.verify = ca_cert
@@ -123,10 +161,11 @@ class DCOSAuth(AuthBase):
                 # This is the expiry for the token itself
                 'exp': self.expiry,
             }
-            r = requests.post(self.login_endpoint,
-                              json=data,
-                              timeout=(3.05, 46),
-                              verify=self.verify)
+            requester = self.session or requests
+            r = requester.post(self.login_endpoint,
+                               json=data,
+                               timeout=(3.05, 46),
+                               verify=self.verify)
             r.raise_for_status()
 
             self.auth_header = 'token=' + r.cookies['dcos-acs-auth-cookie']
@@ -135,6 +174,141 @@ class DCOSAuth(AuthBase):
         return auth_request
 
 
+def new_pooled_session(pool_size, max_retries, backoff_factor):
+    """Create a keep-alive HTTP session with a bounded connection pool.
+
+    Args:
+        pool_size: Maximum number of connections kept open per host
+        max_retries: Number of times a failed request is retried
+        backoff_factor: Backoff factor (seconds) applied between retries
+    """
+    session = requests.Session()
+    retries = Retry(total=max_retries, backoff_factor=backoff_factor)
+    for prefix in ['http://', 'https://']:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retries)
+        session.mount(prefix, adapter)
+    return session
+
+
+def get_session_stats(session):
+    """Get the connection reuse counts for a pooled session.
+
+    Args:
+        session: Session created by new_pooled_session()
+    """
+    stats = {'requests': 0, 'connections': 0}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+    stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+    return stats
+
+
+class LatencyTracker(object):
+    """Track the latency of recent requests to compute percentiles."""
+
+    def __init__(self, window=100, min_samples=10):
+        """Initialize LatencyTracker.
+
+        Args:
+            window: Number of most recent samples kept
+            min_samples: Number of samples needed before percentiles are
+                         reported
+        """
+        self.__samples = deque(maxlen=window)
+        self.__lock = threading.Lock()
+        self.min_samples = min_samples
+
+    def record(self, seconds):
+        """Record the latency of a request."""
+        with self.__lock:
+            self.__samples.append(seconds)
+
+    def percentile(self, pct):
+        """Get the pct-th percentile latency, or None if too few samples."""
+        with self.__lock:
+            samples = sorted(self.__samples)
+        if len(samples) < max(self.min_samples, 1):
+            return None
+        index = int(math.ceil(pct / 100.0 * len(samples))) - 1
+        return samples[min(max(index, 0), len(samples) - 1)]
+
+    def __len__(self):
+        """Number of samples recorded."""
+        with self.__lock:
+            return len(self.__samples)
+
+
+class JSONArrayStream(object):
+    """Incrementally decode the objects of a JSON array from a byte stream.
+
+    The array is the value of 'key' in the top-level JSON object. Each element
+    is yielded as soon as it has been fully received, so only one element
+    (plus the current chunk) is held in memory at a time.
+    """
+
+    def __init__(self, chunks, key):
+        """Initialize JSONArrayStream.
+
+        Args:
+            chunks: Iterable of raw bytes, e.g. Response.iter_content()
+            key: Name of the array in the top-level JSON object
+        """
+        self.chunks = chunks
+        self.key = key
+        self.bytes_decoded = 0
+        self.items_decoded = 0
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        """Yield each element of the array as it is decoded."""
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        start_re = re.compile(r'"%s"\s*:\s*\[' % re.escape(self.key))
+        start_time = time.time()
+        in_array = False
+        buf = u''
+        for chunk in self.chunks:
+            self.bytes_decoded += len(chunk)
+            buf += text_decoder.decode(chunk)
+            if not in_array:
+                match = start_re.search(buf)
+                if not match:
+                    continue
+                buf = buf[match.end():]
+                in_array = True
+            while True:
+                buf = buf.lstrip(u' \t\r\n,')
+                if not buf:
+                    break
+                if buf[0] == u']':
+                    self.elapsed = time.time() - start_time
+                    return
+                try:
+                    item, end = decoder.raw_decode(buf)
+                except ValueError:
+                    # Element is not complete yet, wait for more data
+                    break
+                buf = buf[end:]
+                self.items_decoded += 1
+                yield item
+        self.elapsed = time.time() - start_time
+        if not in_array:
+            raise KeyError(self.key)
+        raise ValueError("JSON array '%s' is incomplete" % self.key)
+
+    def rates(self):
+        """Get the (items, bytes) decoded per second."""
+        if self.elapsed <= 0:
+            return 0.0, 0.0
+        return (self.items_decoded / self.elapsed,
+                self.bytes_decoded / self.elapsed)
+
+
 def get_marathon_auth_params(args):
     """Get the Marathon credentials."""
     marathon_auth = None
@@ -34,6 +34,8 @@ from __future__ import print_function
 
 import json
 import logging
+import Queue
+from collections import OrderedDict
 from operator import attrgetter
 import os
 import os.path
@@ -45,13 +47,14 @@ from itertools import cycle
 from urlparse import urlparse
 
 import configargparse
-import requests
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, HTTPError, Timeout
 from sseclient import SSEClient
 
 from common import (set_logging_args, set_marathon_auth_args,
                     setup_logging, get_marathon_auth_params, resolve_ip,
-                    validate_bigip_address)
+                    validate_bigip_address, new_pooled_session,
+                    get_session_stats, JSONArrayStream, json_loads,
+                    json_dumps, json_backend_name, LatencyTracker)
 from f5_cccl.api import F5CloudServiceManager
 from f5_cccl.exceptions import F5CcclError
 from f5_cccl.utils.mgmt import mgmt_root
@@ -438,6 +441,135 @@ class MarathonApp(object):
         return self.appId == other.appId
 
 
+class MarathonHostSelector(object):
+    """MarathonHostSelector class.
+
+    Probes all the configured Marathon hosts concurrently (/ping and
+    /v2/leader), and ranks them so that healthy hosts come first, the
+    Marathon leader before the other healthy hosts (saving a proxy hop), and
+    otherwise the fastest first.
+    """
+
+    # Timeout (seconds) for each probe request
+    probe_timeout = 2.0
+
+    def __init__(self, hosts, sessions, auth, verify):
+        """Initialize the host selector; all hosts start out healthy."""
+        self.__hosts = hosts
+        self.__sessions = sessions
+        self.__auth = auth
+        self.__verify = verify
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__states = dict()
+        for host in hosts:
+            self.__states[host] = {
+                'healthy': True,
+                'leader': False,
+                'latency': None,
+                'last_probe': None,
+                'last_failure': None,
+                'error': None
+            }
+
+    def start(self, interval):
+        """Probe the hosts now, then every interval seconds in background."""
+        self.probe_all()
+        self.__thread = threading.Thread(target=self.__run, args=(interval,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """Stop the background probing."""
+        self.__stop.set()
+
+    def __run(self, interval):
+        """Background probe loop."""
+        while not self.__stop.wait(interval):
+            try:
+                self.probe_all()
+            except Exception:
+                logger.exception("Unexpected error probing Marathon hosts")
+
+    def probe_all(self):
+        """Probe all the hosts concurrently."""
+        threads = [threading.Thread(target=self.probe, args=(host,))
+                   for host in self.__hosts]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(self.probe_timeout * 2 + 1)
+        logger.debug("Marathon hosts: %s", self.states())
+
+    def probe(self, host):
+        """Probe a single host and record its state."""
+        session = self.__sessions[host]
+        kwargs = {'auth': self.__auth, 'verify': self.__verify,
+                  'timeout': self.probe_timeout}
+        state = {'last_probe': time.time(), 'error': None}
+        try:
+            start_time = time.time()
+            session.get(host + '/ping', **kwargs).raise_for_status()
+            state['latency'] = time.time() - start_time
+
+            response = session.get(host + '/v2/leader', **kwargs)
+            response.raise_for_status()
+            leader = json_loads(response.content).get('leader')
+            state['leader'] = is_same_endpoint(host, leader)
+            state['healthy'] = True
+        except Exception as e:
+            state.update({'healthy': False, 'leader': False,
+                          'last_failure': time.time(), 'error': str(e)})
+        with self.__lock:
+            self.__states[host].update(state)
+
+    def report_failure(self, host):
+        """Mark a host unhealthy until its next successful probe."""
+        with self.__lock:
+            self.__states[host].update({'healthy': False, 'leader': False,
+                                        'last_failure': time.time()})
+
+    def ranked(self):
+        """Get the hosts, best first."""
+        def rank(item):
+            index, host = item
+            state = self.__states[host]
+            if state['healthy']:
+                latency = state['latency']
+                return (0, not state['leader'],
+                        latency if latency is not None else float('inf'),
+                        index)
+            # Rotate through the unhealthy hosts, least recently failed first
+            return (1, state['last_failure'], 0, index)
+
+        with self.__lock:
+            return [host for _, host in
+                    sorted(enumerate(self.__hosts), key=rank)]
+
+    def states(self):
+        """Get a copy of the per-host state."""
+        with self.__lock:
+            return dict((host, dict(state))
+                        for host, state in self.__states.iteritems())
+
+
+def is_same_endpoint(url, leader):
+    """Check whether a Marathon URL points at the leader ('host:port')."""
+    if not leader:
+        return False
+    url = urlparse(url)
+    port = url.port or (443 if url.scheme == 'https' else 80)
+    leader_host, _, leader_port = leader.rpartition(':')
+    if str(port) != leader_port:
+        return False
+    if url.hostname == leader_host:
+        return True
+    url_ip = resolve_ip(url.hostname)
+    return url_ip is not None and url_ip == resolve_ip(leader_host)
+
+
 class Marathon(object):
     """Marathon class.
 
@@ -447,57 +579,295 @@ class Marathon(object):
         * Retrieves Marathon application state
     """
 
-    def __init__(self, hosts, health_check, auth, ca_cert=None):
-        """Initialize the Marathon object."""
+    # Size of the chunks read from the socket when streaming the app list
+    stream_chunk_size = 65536
+
+    # Timeout (seconds) to establish a connection to a Marathon host
+    connect_timeout = 3.05
+
+    def __init__(self, hosts, health_check, auth, ca_cert=None,
+                 pool_size=10, max_retries=3, retry_backoff=0.1,
+                 stream_apps=False, probe_interval=None, timeout=30,
+                 hedge_percentile=0, partitions=None):
+        """Initialize the Marathon object.
+
+        Only the apps labeled with one of the partitions are listed; all
+        apps are listed if partitions is None.
+        """
         self.__hosts = hosts
+        self.__partitions = partitions
+        self.__timeout = timeout
+        self.__hedge_percentile = hedge_percentile
+        self.__latency = LatencyTracker()
+        self.__hedged_requests = 0
         self.__health_check = health_check
+        self.__stream_apps = stream_apps
         self.__auth = auth
         self.__cycle_hosts = cycle(self.__hosts)
         self.__verify = False
         if ca_cert:
             self.__verify = ca_cert
 
-    def api_req_raw(self, method, path, auth, **kwargs):
-        """Send an API request to Marathon and return the response."""
+        # One keep-alive connection pool per Marathon host, shared by the
+        # API requests and the event stream
+        self.__sessions = dict()
         for host in self.__hosts:
-            path_str = os.path.join(host, 'v2')
-
-            for path_elem in path:
-                path_str = path_str + "/" + path_elem
-            response = requests.request(
-                method,
-                path_str,
-                auth=auth,
-                headers={
-                    'Accept': 'application/json',
-                    'Content-Type': 'application/json'
-                },
-                **kwargs
-            )
-
-            logger.debug("%s %s", method, response.url)
+            self.__sessions[host] = new_pooled_session(
+                pool_size, max_retries, retry_backoff)
+        if hasattr(self.__auth, 'session'):
+            self.__auth.session = new_pooled_session(
+                pool_size, max_retries, retry_backoff)
+
+        # Leader/health aware host selection, probed in the background
+        self.__selector = None
+        if probe_interval:
+            self.__selector = MarathonHostSelector(
+                self.__hosts, self.__sessions, self.__auth, self.__verify)
+            self.__selector.start(probe_interval)
+
+    def session(self, host):
+        """Get the pooled HTTP session for a Marathon host."""
+        return self.__sessions[host]
+
+    def connection_stats(self):
+        """Get the connection reuse counts for each Marathon host."""
+        stats = dict()
+        for host in self.__hosts:
+            stats[host] = get_session_stats(self.__sessions[host])
+        return stats
+
+    def hosts(self):
+        """Get the Marathon hosts in the order they should be tried."""
+        if self.__selector:
+            return self.__selector.ranked()
+        return self.__hosts
+
+    def host_states(self):
+        """Get the probed state of each Marathon host."""
+        if self.__selector:
+            return self.__selector.states()
+        return dict()
+
+    def report_failure(self, host):
+        """Demote a Marathon host that failed a request."""
+        if self.__selector:
+            self.__selector.report_failure(host)
+
+    def latency_stats(self):
+        """Get the observed Marathon request latency and hedging counts."""
+        return {
+            'samples': len(self.__latency),
+            'p50': self.__latency.percentile(50),
+            'hedge_delay': self.__latency.percentile(self.__hedge_percentile)
+            if self.__hedge_percentile else None,
+            'hedged_requests': self.__hedged_requests
+        }
+
+    def api_req_raw(self, method, path, auth, deadline=None, **kwargs):
+        """Send an API request to Marathon and return the response.
+
+        The request is tried on each host in turn until one of them answers
+        or the deadline (seconds) expires. When hedging is enabled, a GET that
+        takes longer than the configured percentile of the observed latency is
+        also sent to the next host, and the first good response wins.
+        """
+        if deadline is None:
+            deadline = self.__timeout
+        expires = time.time() + deadline
+        hosts = self.hosts()
+        if self.__hedge_percentile and method == 'GET' and \
+                not kwargs.get('stream') and len(hosts) > 1:
+            response = self.__hedged_request(hosts, method, path, auth,
+                                             expires, **kwargs)
+        else:
+            response = self.__sequential_request(hosts, method, path, auth,
+                                                 expires, **kwargs)
+
+        if response.status_code != 200 and not kwargs.get('stream') and \
+                response.content:
+            # Add Marathon's error message to the reason
+            try:
+                message = json_loads(response.content).get('message')
+            except (ValueError, AttributeError):
+                message = None
+            if message:
+                response.reason = "%s (%s)" % (response.reason, message)
+
+        response.raise_for_status()
+        return response
+
+    def __send(self, host, method, path, auth, expires, **kwargs):
+        """Send an API request to a single Marathon host."""
+        path_str = os.path.join(host, 'v2')
+
+        for path_elem in path:
+            path_str = path_str + "/" + path_elem
+
+        remaining = max(expires - time.time(), 0.001)
+        start_time = time.time()
+        response = self.__sessions[host].request(
+            method,
+            path_str,
+            auth=auth,
+            headers={
+                'Accept': 'application/json',
+                'Content-Type': 'application/json'
+            },
+            timeout=(min(self.connect_timeout, remaining), remaining),
+            **kwargs
+        )
+
+        logger.debug("%s %s", method, response.url)
+        if response.status_code == 200 and method == 'GET' and \
+                not kwargs.get('stream'):
+            self.__latency.record(time.time() - start_time)
+        return response
+
+    def __sequential_request(self, hosts, method, path, auth, expires,
+                             **kwargs):
+        """Try each host in turn until one answers 200."""
+        response = None
+        error = None
+        for host in hosts:
+            if time.time() >= expires:
+                break
+            try:
+                response = self.__send(host, method, path, auth, expires,
+                                       **kwargs)
+            except (ConnectionError, Timeout) as e:
+                logger.warning("%s %s failed: %s", method, host, e)
+                self.report_failure(host)
+                error = e
+                continue
+
             if response.status_code == 200:
                 break
 
-        response.raise_for_status()
+        if response is None:
+            # No Marathon host answered in time
+            raise error or Timeout("Marathon request deadline expired")
+        return response
+
+    def __hedged_request(self, hosts, method, path, auth, expires, **kwargs):
+        """Send the request to the next host if the current one is slow."""
+        hosts = list(hosts)
+        delay = self.__latency.percentile(self.__hedge_percentile)
+        results = Queue.Queue()
+
+        def send(host):
+            try:
+                results.put((host, self.__send(host, method, path, auth,
+                                               expires, **kwargs), None))
+            except Exception as e:
+                results.put((host, None, e))
+
+        def send_next():
+            thread = threading.Thread(target=send, args=(hosts.pop(0),))
+            thread.daemon = True
+            thread.start()
+
+        send_next()
+        pending = 1
+        response = None
+        error = None
+        while pending:
+            wait = max(expires - time.time(), 0)
+            if hosts and delay is not None:
+                wait = min(wait, delay)
+            try:
+                host, result, e = results.get(timeout=wait)
+            except Queue.Empty:
+                if not hosts or time.time() >= expires:
+                    # Deadline expired; abandon the outstanding requests
+                    break
+                logger.debug("Hedging %s %s after %.3fs", method,
+                             '/'.join(path), delay)
+                self.__hedged_requests += 1
+                send_next()
+                pending += 1
+                continue
+
+            pending -= 1
+            if e is not None:
+                logger.warning("%s %s failed: %s", method, host, e)
+                if isinstance(e, (ConnectionError, Timeout)):
+                    self.report_failure(host)
+                error = e
+            elif result.status_code == 200:
+                return result
+            else:
+                response = result
+            if hosts and pending == 0:
+                send_next()
+                pending += 1
 
-        if 'message' in response.json():
-            response.reason = "%s (%s)" % (
-                response.reason,
-                response.json()['message'])
+        if response is None:
+            raise error or Timeout("Marathon request deadline expired")
         return response
 
     def api_req(self, method, path, **kwargs):
         """Send an API request to Marathon and return the JSON response."""
-        return self.api_req_raw(method, path, self.__auth,
-                                verify=self.__verify, **kwargs).json()
+        response = self.api_req_raw(method, path, self.__auth,
+                                    verify=self.__verify, **kwargs)
+        return json_loads(response.content)
 
     # Lists all running apps.
     def list(self):
-        """Get the app list from Marathon."""
+        """Get the app list from Marathon.
+
+        When streaming is enabled an iterator is returned that decodes the
+        apps one at a time as they arrive, otherwise a list.
+        """
+        if self.__stream_apps:
+            return self.iter_apps()
         logger.info('fetching apps')
-        return self.api_req('GET', ['apps'],
-                            params={'embed': 'apps.tasks'})["apps"]
+        apps = self.api_req('GET', ['apps'],
+                            params=self.list_params())["apps"]
+        logger.debug("Marathon connection stats: %s", self.connection_stats())
+        return apps
+
+    def list_params(self):
+        """Get the query parameters of the app list request."""
+        params = {'embed': 'apps.tasks'}
+        if self.__partitions is not None:
+            params['label'] = label_selector(self.__partitions)
+        return params
+
+    def get_app(self, appId):
+        """Get a single app and its tasks from Marathon.
+
+        Returns None if the app does not exist.
+        """
+        logger.info('fetching app %s', appId)
+        try:
+            return self.api_req('GET', ['apps'] + appId.strip('/').split('/'),
+                                params={'embed': 'app.tasks'})['app']
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+    def iter_apps(self):
+        """Stream the app list from Marathon, decoding one app at a time."""
+        logger.info('fetching apps (streaming)')
+        response = self.api_req_raw('GET', ['apps'], self.__auth,
+                                    verify=self.__verify,
+                                    params=self.list_params(),
+                                    stream=True)
+        try:
+            stream = JSONArrayStream(
+                response.iter_content(self.stream_chunk_size), 'apps')
+            for app in stream:
+                yield app
+        finally:
+            response.close()
+
+        apps_rate, bytes_rate = stream.rates()
+        logger.info("decoded %d apps (%d bytes) in %.3fs: %.1f apps/s, "
+                    "%.1f bytes/s", stream.items_decoded,
+                    stream.bytes_decoded, stream.elapsed, apps_rate,
+                    bytes_rate)
+        logger.debug("Marathon connection stats: %s", self.connection_stats())
 
     def health_check(self):
         """Get health check."""
@@ -505,18 +875,313 @@ class Marathon(object):
 
     def get_event_stream(self, timeout):
         """Get the Server Side Event (SSE) event stream."""
-        url = self.host+"/v2/events"
+        host = self.host
+        url = host+"/v2/events"
         logger.info(
             "SSE Active, trying fetch events from from {0}".format(url))
-        return SSEClient(url, auth=self.__auth, verify=self.__verify,
-                         timeout=timeout)
+        try:
+            return SSEClient(url, session=self.__sessions[host],
+                             auth=self.__auth, verify=self.__verify,
+                             timeout=timeout)
+        except Exception:
+            self.report_failure(host)
+            raise
 
     @property
     def host(self):
-        """Cycle the the configured set of Marathon hosts."""
+        """Get the best Marathon host.
+
+        Without host probing, cycle the the configured set of Marathon hosts.
+        """
+        if self.__selector:
+            return self.__selector.ranked()[0]
         return next(self.__cycle_hosts)
 
 
+# Task states that mean the task no longer exists on its agent
+terminal_task_states = frozenset([
+    'TASK_FINISHED', 'TASK_FAILED', 'TASK_KILLED', 'TASK_LOST',
+    'TASK_ERROR', 'TASK_DROPPED', 'TASK_GONE', 'TASK_GONE_BY_OPERATOR',
+    'TASK_UNREACHABLE', 'TASK_UNKNOWN'
+])
+
+# Instance conditions that mean the instance's tasks no longer exist
+terminal_instance_conditions = frozenset([
+    'Error', 'Failed', 'Finished', 'Killed', 'Gone', 'Dropped', 'Unknown',
+    'Unreachable', 'UnreachableInactive'
+])
+
+# App and task fields used when parsing the Marathon state; everything else
+# in the Marathon payload is dropped when it is stored
+app_fields = ['id', 'labels', 'ports', 'healthChecks', 'version',
+              'versionInfo']
+task_fields = ['id', 'appId', 'host', 'ports', 'state', 'version',
+               'draining', 'healthCheckResults']
+
+
+def label_selector(partitions):
+    """Create the Marathon label selector for the apps in the partitions.
+
+    Without partitions the selector matches every app that has an
+    F5_PARTITION label.
+    """
+    if not partitions:
+        return 'F5_PARTITION'
+    # Escape the characters that are not valid in a selector value
+    values = [re.sub(r'([^a-zA-Z0-9_./-])', r'\\\1', partition)
+              for partition in partitions]
+    return 'F5_PARTITION in (%s)' % ', '.join(values)
+
+
+def is_managed_app(app, partitions):
+    """Check whether an app belongs to one of the managed partitions.
+
+    Every app is managed when partitions is None.
+    """
+    if partitions is None:
+        return True
+    return app.get('labels', {}).get('F5_PARTITION') in partitions
+
+
+def trim_task(task):
+    """Keep only the task fields used to build the backends."""
+    return dict((k, task[k]) for k in task_fields if k in task)
+
+
+def trim_app(app):
+    """Keep only the app fields used to build the services."""
+    trimmed = dict((k, app[k]) for k in app_fields if k in app)
+    port_mappings = app.get('container', {}).get('portMappings')
+    if port_mappings is not None:
+        trimmed['container'] = {'portMappings': port_mappings}
+    return trimmed
+
+
+class MarathonState(object):
+    """MarathonState class.
+
+    Authoritative in-memory index of the Marathon apps and their tasks
+    (appId -> taskId -> task). It is rebuilt from a full Marathon fetch and
+    patched in between from the task events in the event stream. Only the
+    apps in the managed partitions are kept; the IDs of the other apps seen
+    are remembered so that their events can be ignored.
+    """
+
+    def __init__(self, partitions=None):
+        """Initialize an empty MarathonState."""
+        self.__lock = threading.Lock()
+        self.__partitions = partitions
+        # IDs of the apps that are not in a managed partition
+        self.__ignored = set()
+        # appId -> app (without tasks), in Marathon order
+        self.__apps = OrderedDict()
+        # appId -> taskId -> task
+        self.__tasks = dict()
+        self.__populated = False
+        # Events received while a full fetch is in flight
+        self.__journal = None
+
+    @property
+    def populated(self):
+        """True once the state has been loaded from Marathon."""
+        return self.__populated
+
+    def begin_reset(self):
+        """Start recording events that must be replayed after a reset."""
+        with self.__lock:
+            self.__journal = []
+
+    def reset(self, apps):
+        """Rebuild the state from the full Marathon app list.
+
+        Events applied since begin_reset() are replayed on top, since the
+        fetched app list may predate them.
+        """
+        new_apps = OrderedDict()
+        new_tasks = dict()
+        ignored = set()
+        for app in apps:
+            appId = app['id']
+            if not self.is_managed(app):
+                # Marathon servers without label selector support return
+                # every app
+                ignored.add(appId)
+                continue
+            new_apps[appId] = trim_app(app)
+            new_tasks[appId] = OrderedDict(
+                (task['id'], trim_task(task)) for task in app['tasks'])
+
+        with self.__lock:
+            self.__apps = new_apps
+            self.__tasks = new_tasks
+            self.__ignored.update(ignored)
+            self.__ignored.difference_update(new_apps)
+            self.__populated = True
+            self.__replay_journal()
+
+    def update_app(self, appId, app):
+        """Replace a single app and its tasks with freshly fetched data.
+
+        An app of None removes the app. Events applied since begin_reset()
+        are replayed on top.
+        """
+        with self.__lock:
+            if app is None:
+                self.__ignored.discard(appId)
+                self.__remove_app(appId)
+            elif not self.is_managed(app):
+                self.__ignored.add(appId)
+                self.__remove_app(appId)
+            else:
+                self.__ignored.discard(appId)
+                self.__tasks[appId] = OrderedDict(
+                    (task['id'], trim_task(task)) for task in app['tasks'])
+                self.__apps[appId] = trim_app(app)
+            self.__replay_journal()
+
+    def is_managed(self, app):
+        """Check whether an app belongs to a managed partition."""
+        return is_managed_app(app, self.__partitions)
+
+    def is_ignored(self, appId):
+        """Check whether an app is known not to be in a managed partition."""
+        with self.__lock:
+            return appId in self.__ignored
+
+    def ignore_app(self, appId):
+        """Drop an app that is not in a managed partition.
+
+        Returns True if the app was known.
+        """
+        with self.__lock:
+            self.__ignored.add(appId)
+            if self.__journal is not None:
+                self.__journal.append({'eventType': 'app_terminated_event',
+                                       'appId': appId})
+            return self.__remove_app(appId)
+
+    def update_app_definition(self, app):
+        """Update the definition of a known app, keeping its tasks.
+
+        Returns False if the app is not known or the definition lacks the
+        port data needed to build its services.
+        """
+        with self.__lock:
+            if self.__journal is not None:
+                self.__journal.append({'eventType': 'api_post_event',
+                                       'appDefinition': app})
+            return self.__update_app_definition(app)
+
+    def __update_app_definition(self, app):
+        """Update the definition of a known app (lock must be held)."""
+        has_ports = 'ports' in app or \
+            'portMappings' in app.get('container', {})
+        if app['id'] not in self.__apps or not has_ports:
+            return False
+        self.__apps[app['id']] = trim_app(app)
+        return True
+
+    def remove_app(self, appId):
+        """Remove an app and its tasks.
+
+        Returns False if the app is not known.
+        """
+        with self.__lock:
+            self.__ignored.discard(appId)
+            if self.__journal is not None:
+                self.__journal.append({'eventType': 'app_terminated_event',
+                                       'appId': appId})
+            return self.__remove_app(appId)
+
+    def __remove_app(self, appId):
+        """Remove an app and its tasks (lock must be held)."""
+        self.__tasks.pop(appId, None)
+        return self.__apps.pop(appId, None) is not None
+
+    def __replay_journal(self):
+        """Stop recording events and replay them (lock must be held)."""
+        journal = self.__journal or []
+        self.__journal = None
+        for event in journal:
+            self.__apply(event)
+
+    def apps(self):
+        """Get a snapshot of the Marathon apps with their tasks."""
+        with self.__lock:
+            return [dict(app, tasks=list(self.__tasks[appId].values()))
+                    for appId, app in self.__apps.iteritems()]
+
+    def apply_event(self, event):
+        """Patch the task index from a task event.
+
+        Returns True if the index was patched, False if the event did not
+        change it or refers to state that is not known (e.g. a new app).
+        """
+        with self.__lock:
+            if self.__journal is not None:
+                self.__journal.append(event)
+            return self.__apply(event)
+
+    def __apply(self, event):
+        """Apply an event to the index (lock must be held)."""
+        if event['eventType'] == 'status_update_event':
+            return self.__apply_status_update(event)
+        if event['eventType'] == 'instance_changed_event':
+            return self.__apply_instance_changed(event)
+        if event['eventType'] == 'app_terminated_event':
+            return self.__remove_app(event.get('appId'))
+        if event['eventType'] == 'api_post_event':
+            return self.__update_app_definition(event['appDefinition'])
+        return False
+
+    def __apply_status_update(self, event):
+        """Add, update or remove the task in a status_update_event."""
+        tasks = self.__tasks.get(event.get('appId'))
+        taskId = event.get('taskId')
+        if tasks is None or taskId is None:
+            return False
+
+        if event.get('taskStatus') in terminal_task_states:
+            tasks.pop(taskId, None)
+            return True
+
+        task = tasks.get(taskId, {})
+        task.update({
+            'id': taskId,
+            'appId': event.get('appId'),
+            'host': event.get('host', ''),
+            'ports': event.get('ports', []),
+            'state': event.get('taskStatus')
+        })
+        if 'version' in event:
+            task['version'] = event['version']
+        tasks[taskId] = task
+        return True
+
+    def __apply_instance_changed(self, event):
+        """Remove the tasks of an instance that is gone.
+
+        Instance events carry no ports, so new or running instances are
+        handled by the status_update_event sent for their tasks.
+        """
+        tasks = self.__tasks.get(event.get('runSpecId'))
+        if tasks is None or \
+                event.get('condition') not in terminal_instance_conditions:
+            return False
+
+        instanceId = event.get('instanceId', '')
+        # Instance '<app>.marathon-<uuid>' runs task '<app>.<uuid>'; newer
+        # instances '<app>.instance-<uuid>' run '<app>.instance-<uuid>.*'
+        legacyTaskId = instanceId.replace('.marathon-', '.', 1)
+        removed = False
+        for taskId in list(tasks.keys()):
+            if taskId in (instanceId, legacyTaskId) or \
+                    taskId.startswith(instanceId + '.'):
+                del tasks[taskId]
+                removed = True
+        return removed
+
+
 def get_health_check(app, portIndex):
     """Get the healthcheck for the app."""
     checks = []
@@ -528,23 +1193,35 @@ def get_health_check(app, portIndex):
     return None
 
 
-def get_apps(apps, health_check):
-    """Create a list of app services from the Marathon state."""
-    marathon_apps = []
-    logger.debug("Marathon apps: %s", [app["id"] for app in apps])
+def get_apps(apps, health_check, partitions=None):
+    """Create a list of app services from the Marathon state.
+
+    Args:
+        apps: Iterable of Marathon app dicts; each app is parsed as soon as
+              it is produced, so this may be a streaming decoder
+        health_check: Respect the Marathon health check results
+        partitions: If set, apps outside these partitions are skipped
+                    before their services are parsed
+    """
+    # Convert into a list for easier consumption
+    apps_list = []
+    app_ids = []
 
     for app in apps:
         logger.info("Working on app %s", app['id'])
         appId = app['id']
+        app_ids.append(appId)
         if appId[1:] == os.environ.get("FRAMEWORK_NAME"):
             continue
+        if not is_managed_app(app, partitions):
+            logger.debug("Skipping app %s, not in a managed partition", appId)
+            continue
 
         marathon_app = MarathonApp(appId, app)
 
         if 'F5_PARTITION' in marathon_app.app['labels']:
             marathon_app.partition = \
                 marathon_app.app['labels']['F5_PARTITION']
-        marathon_apps.append(marathon_app)
 
         # 'ports' does not exist in Marathon v1.5.2 and when DC/OS Virtual
         # Networking is used.
@@ -632,12 +1309,10 @@ def get_apps(apps, health_check):
                                         task_port,
                                         draining)
 
-    # Convert into a list for easier consumption
-    apps_list = []
-    for marathon_app in marathon_apps:
-        for service in list(marathon_app.services.values()):
-            apps_list.append(service)
+        # Only the services are kept; the raw app data is released
+        apps_list.extend(marathon_app.services.values())
 
+    logger.debug("Marathon apps: %s", app_ids)
     logger.debug("Marathon app list: %s", repr(apps_list))
 
     return apps_list
@@ -732,7 +1407,7 @@ def create_config_marathon(cccl, apps):
             try:
                 # Decode the tables
                 for key in app.iappTables:
-                    cfg['tables'][key] = json.loads(app.iappTables[key])
+                    cfg['tables'][key] = json_loads(app.iappTables[key])
             except ValueError:
                 logger.error("IAPP TABLE data is not valid JSON")
                 continue
@@ -846,7 +1521,7 @@ def create_config_marathon(cccl, apps):
             }
             services['pools'].append(pool)
 
-    logger.debug("Service Config: %s", json.dumps(services))
+    logger.debug("Service Config: %s", json_dumps(services))
 
     return services
 
@@ -858,21 +1533,27 @@ class MarathonEventProcessor(object):
     reconfigures the BIG-IP
     """
 
-    def __init__(self, marathon, verify_interval, cccls):
+    def __init__(self, marathon, verify_interval, cccls, partitions=None):
         """Class init.
 
         Starts a thread that waits for Marathon events,
-        then configures BIG-IP based on the Marathon state
+        then configures BIG-IP based on the Marathon state. If partitions is
+        set, only the apps in those partitions are tracked.
         """
         self.__marathon = marathon
         # appId -> MarathonApp
         self.__apps = dict()
+        # Marathon apps and tasks, patched from events between full fetches
+        self.__state = MarathonState(partitions)
         self.__cccls = cccls
         self.__verify_interval = verify_interval
 
         self.__condition = threading.Condition()
         self.__thread = threading.Thread(target=self.do_reset)
         self.__pending_reset = False
+        self.__pending_fetch = False
+        # Apps that must be fetched individually before the next reconcile
+        self.__pending_apps = set()
         self.__thread.daemon = True
         self.__thread.start()
         self.__timer = None
@@ -890,6 +1571,10 @@ class MarathonEventProcessor(object):
                 if not self.__pending_reset:
                     self.__condition.wait()
                 self.__pending_reset = False
+                fetch = self.__pending_fetch or not self.__state.populated
+                self.__pending_fetch = False
+                fetch_apps = self.__pending_apps
+                self.__pending_apps = set()
                 self.__condition.release()
 
                 try:
@@ -899,8 +1584,19 @@ class MarathonEventProcessor(object):
                         self.__timer.cancel()
                         self.__timer = None
 
+                    if fetch:
+                        # Full fetch; events received in the meantime are
+                        # replayed on top of the fetched state
+                        self.__state.begin_reset()
+                        self.__state.reset(self.__marathon.list())
+                    else:
+                        for appId in fetch_apps:
+                            self.__state.begin_reset()
+                            self.__state.update_app(
+                                appId, self.__marathon.get_app(appId))
+
                     self.__apps = \
-                        sorted(get_apps(self.__marathon.list(),
+                        sorted(get_apps(self.__state.apps(),
                                         self.__marathon.health_check()),
                                key=attrgetter('appId', 'servicePort'))
 
@@ -968,9 +1664,25 @@ class MarathonEventProcessor(object):
         self.__timer.start()
 
     def reset_from_tasks(self):
-        """Indicate that we need to process the Marathon state."""
+        """Indicate that we need to fetch and process the Marathon state."""
         self.__condition.acquire()
         self.__pending_reset = True
+        self.__pending_fetch = True
+        self.__condition.notify()
+        self.__condition.release()
+
+    def reset_from_state(self):
+        """Indicate that we need to process the cached Marathon state."""
+        self.__condition.acquire()
+        self.__pending_reset = True
+        self.__condition.notify()
+        self.__condition.release()
+
+    def reset_from_app(self, appId):
+        """Indicate that we need to fetch an app and process the state."""
+        self.__condition.acquire()
+        self.__pending_reset = True
+        self.__pending_apps.add(appId)
         self.__condition.notify()
         self.__condition.release()
 
@@ -978,13 +1690,44 @@ class MarathonEventProcessor(object):
         """Check Marathon event.
 
         If a Marathon event in which we are interested occurs, wake up the
-        thread and process the Marathon state
+        thread and process the Marathon state. Task and app events are applied
+        to the cached state directly, fetching only the affected app if the
+        event doesn't carry enough data; the others require a full fetch.
+        Task events of apps outside the managed partitions are dropped.
         """
-        if event['eventType'] == 'status_update_event' or \
-                event['eventType'] == 'event_stream_attached' or \
-                event['eventType'] == 'health_status_changed_event' or \
-                event['eventType'] == 'app_terminated_event' or \
-                event['eventType'] == 'api_post_event':
+        if event['eventType'] == 'status_update_event':
+            appId = event.get('appId')
+            if self.__state.is_ignored(appId):
+                pass
+            elif self.__state.apply_event(event):
+                self.reset_from_state()
+            elif appId is not None:
+                # Task of an app we don't know about yet
+                self.reset_from_app(appId)
+            else:
+                self.reset_from_tasks()
+        elif event['eventType'] == 'instance_changed_event':
+            if not self.__state.is_ignored(event.get('runSpecId')) and \
+                    self.__state.apply_event(event):
+                self.reset_from_state()
+        elif event['eventType'] == 'app_terminated_event':
+            if self.__state.remove_app(event.get('appId')):
+                self.reset_from_state()
+        elif event['eventType'] == 'api_post_event':
+            app = event.get('appDefinition')
+            if app is None or 'id' not in app:
+                self.reset_from_tasks()
+            elif not self.__state.is_managed(app):
+                # Not (or no longer) in a managed partition
+                if self.__state.ignore_app(app['id']):
+                    self.reset_from_state()
+            elif self.__state.update_app_definition(app):
+                self.reset_from_state()
+            else:
+                # New app, or not enough data in the event
+                self.reset_from_app(app['id'])
+        elif event['eventType'] == 'event_stream_attached' or \
+                event['eventType'] == 'health_status_changed_event':
             self.reset_from_tasks()
 
 
@@ -1032,6 +1775,39 @@ def get_arg_parser():
                         env_var='F5_CC_VERIFY_INTERVAL',
                         default=30, help="Interval at which to verify "
                         "the BIG-IP configuration.")
+    parser.add_argument('--marathon-pool-size', type=int,
+                        env_var='F5_CC_MARATHON_POOL_SIZE',
+                        default=10, help="Maximum number of keep-alive "
+                        "connections to each Marathon host.")
+    parser.add_argument('--marathon-retries', type=int,
+                        env_var='F5_CC_MARATHON_RETRIES',
+                        default=3, help="Number of times a failed Marathon "
+                        "request is retried.")
+    parser.add_argument('--marathon-retry-backoff', type=float,
+                        env_var='F5_CC_MARATHON_RETRY_BACKOFF',
+                        default=0.1, help="Backoff factor (in seconds) "
+                        "between Marathon request retries.")
+    parser.add_argument("--marathon-stream-apps",
+                        env_var='F5_CC_MARATHON_STREAM_APPS',
+                        help="If set, decode the Marathon app list "
+                        "incrementally as it is received to bound memory "
+                        "usage.",
+                        action="store_true")
+    parser.add_argument('--marathon-probe-interval', type=int,
+                        env_var='F5_CC_MARATHON_PROBE_INTERVAL',
+                        default=10, help="Interval at which to probe the "
+                        "health and leadership of the Marathon hosts; 0 "
+                        "disables probing.")
+    parser.add_argument('--marathon-timeout', type=float,
+                        env_var='F5_CC_MARATHON_TIMEOUT',
+                        default=30, help="Deadline (in seconds) for each "
+                        "Marathon API request, across all Marathon hosts.")
+    parser.add_argument('--marathon-hedge-percentile', type=int,
+                        env_var='F5_CC_MARATHON_HEDGE_PERCENTILE',
+                        default=0, help="If set, a Marathon API request "
+                        "that takes longer than this percentile of the "
+                        "observed latency is also sent to the next Marathon "
+                        "host; 0 disables hedging.")
     parser.add_argument("--version",
                         help="Print out version information and exit",
                         action="store_true")
@@ -1051,7 +1827,7 @@ def process_sse_events(processor, events):
                 # marathon sometimes sends more than one json per event
                 # e.g. {}\r\n{}\r\n\r\n
                 for real_event_data in re.split(r'\r\n', event.data):
-                    data = json.loads(real_event_data)
+                    data = json_loads(real_event_data)
                     logger.info(
                         "received event of type {0}".format(data['eventType']))
                     if data['eventType'] == 'event_stream_detached':
@@ -1102,6 +1878,21 @@ def parse_args(version_data):
             arg_parser.error('argument --sse-timeout must be > 0')
         if args.verify_interval < 1:
             arg_parser.error('argument --verification-interval must be > 0')
+        if args.marathon_timeout <= 0:
+            arg_parser.error('argument --marathon-timeout must be > 0')
+        if args.marathon_hedge_percentile < 0 or \
+                args.marathon_hedge_percentile > 99:
+            arg_parser.error('argument --marathon-hedge-percentile must be '
+                             'between 0 and 99')
+        if args.marathon_probe_interval < 0:
+            arg_parser.error('argument --marathon-probe-interval must be '
+                             '>= 0')
+        if args.marathon_pool_size < 1:
+            arg_parser.error('argument --marathon-pool-size must be > 0')
+        if args.marathon_retries < 0:
+            arg_parser.error('argument --marathon-retries must be >= 0')
+        if args.marathon_retry_backoff < 0:
+            arg_parser.error('argument --marathon-retry-backoff must be >= 0')
 
         if not urlparse(args.hostname).scheme:
             args.hostname = "https://" + args.hostname
@@ -1141,6 +1932,7 @@ if __name__ == '__main__':
     # Version/build info
     logger.info("Version: %s, Build: %s", version_data['version'],
                 version_data['build'])
+    logger.info("JSON backend: %s", json_backend_name)
 
     # BIG-IP to manage
     bigip = mgmt_root(
@@ -1164,11 +1956,6 @@ if __name__ == '__main__':
             prefix="")
         cccls.append(cccl)
 
-    # Set request retries
-    s = requests.Session()
-    a = requests.adapters.HTTPAdapter(max_retries=3)
-    s.mount('http://', a)
-
     if os.environ.get('SCALE_PERF_ENABLE'):
         logger.info('SCALE_PERF: Started controller at: %f', time.time())
 
@@ -1176,9 +1963,18 @@ if __name__ == '__main__':
     marathon = Marathon(args.marathon,
                         args.health_check,
                         get_marathon_auth_params(args),
-                        args.marathon_ca_cert)
-
-    processor = MarathonEventProcessor(marathon, args.verify_interval, cccls)
+                        args.marathon_ca_cert,
+                        args.marathon_pool_size,
+                        args.marathon_retries,
+                        args.marathon_retry_backoff,
+                        args.marathon_stream_apps,
+                        args.marathon_probe_interval,
+                        args.marathon_timeout,
+                        args.marathon_hedge_percentile,
+                        args.partition)
+
+    processor = MarathonEventProcessor(marathon, args.verify_interval, cccls,
+                                       args.partition)
     while True:
         try:
             events = marathon.get_event_stream(args.sse_timeout)
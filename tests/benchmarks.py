@@ -0,0 +1,74 @@
+# Copyright 2017 F5 Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Controller Microbenchmarks.
+
+Run from the top of the repository, for example:
+
+    python -m tests.benchmarks codec --repeat 200
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import timeit
+
+from common import get_json_backends
+
+
+def bench_codec(args):
+    """Compare the JSON backends on the recorded Marathon payloads."""
+    payloads = []
+    for data_file in sorted(glob.glob('tests/marathon_*.json')):
+        if data_file.endswith('_expected.json'):
+            continue
+        with open(data_file) as json_data:
+            apps = json.load(json_data)
+        # Scale each fixture up to a cluster-sized payload
+        payloads.append(json.dumps({'apps': apps * args.scale}))
+
+    total_bytes = sum(len(p) for p in payloads)
+    print("%d payloads, %d bytes" % (len(payloads), total_bytes))
+    print("%-12s %12s %12s" % ('backend', 'loads MB/s', 'dumps MB/s'))
+    for name, backend in get_json_backends():
+        decoded = [backend.loads(p) for p in payloads]
+        loads_time = min(timeit.repeat(
+            lambda: [backend.loads(p) for p in payloads],
+            number=args.repeat, repeat=3))
+        dumps_time = min(timeit.repeat(
+            lambda: [backend.dumps(d) for d in decoded],
+            number=args.repeat, repeat=3))
+        mbytes = total_bytes * args.repeat / 1e6
+        print("%-12s %12.1f %12.1f" % (name, mbytes / loads_time,
+                                       mbytes / dumps_time))
+
+
+def main():
+    """Run the selected benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers()
+
+    codec = subparsers.add_parser('codec', help=bench_codec.__doc__)
+    codec.add_argument('--repeat', type=int, default=100)
+    codec.add_argument('--scale', type=int, default=10,
+                       help='Number of copies of each fixture app')
+    codec.set_defaults(func=bench_codec)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
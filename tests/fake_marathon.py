@@ -0,0 +1,673 @@
+# Copyright 2017 F5 Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fake Marathon Server.
+
+Stand-in for the Marathon API that serves a synthetic cluster, so that the
+controller can be driven end to end without a DC/OS cluster. It serves
+/ping, /v2/leader, /v2/apps, /v2/apps/{id} and the /v2/events stream, and
+can script scale-ups, task kills, deployments and leader changes.
+
+Run from the top of the repository, for example:
+
+    python -m tests.fake_marathon --apps 1000 --tasks 10 --ports 2
+
+then point the controller at the printed Marathon URLs.
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import json
+import Queue
+import random
+import re
+import threading
+import time
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+# Label selector terms, e.g. 'key', 'key==value', 'key in (a, b)'
+selector_term = re.compile(
+    r'\s*((?:[^\s,=!\\]|\\.)+)\s*'
+    r'(?:(==|!=)\s*((?:[^,\\]|\\.)*)|\s(in|notin)\s*\(((?:[^)\\]|\\.)*)\))?'
+    r'\s*(?:,|$)')
+
+
+def unescape(value):
+    """Remove the backslash escapes from a label selector value."""
+    return re.sub(r'\\(.)', r'\1', value.strip())
+
+
+def match_label_selector(labels, selector):
+    """Check whether app labels match a Marathon label selector."""
+    pos = 0
+    while pos < len(selector):
+        term = selector_term.match(selector, pos)
+        if term is None or term.end() == pos:
+            raise ValueError("Invalid label selector: %s" % selector)
+        pos = term.end()
+
+        key, op, value, set_op, values = term.groups()
+        key = unescape(key)
+        if op == '==' and labels.get(key) != unescape(value):
+            return False
+        if op == '!=' and labels.get(key) == unescape(value):
+            return False
+        if set_op is not None:
+            value_set = set(unescape(v) for v in
+                            re.split(r'(?<!\\),', values))
+            if (labels.get(key) in value_set) != (set_op == 'in'):
+                return False
+        if op is None and set_op is None and key not in labels:
+            return False
+    return True
+
+
+def timestamp():
+    """Get the current time in Marathon's format."""
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+
+
+def generate_task(app, rng):
+    """Create a running task for an app."""
+    taskId = '%s.%s' % (app['id'].strip('/').replace('/', '_'), uuid.uuid4())
+    now = timestamp()
+    return {
+        'id': taskId,
+        'appId': app['id'],
+        'host': '10.1.%d.%d' % (rng.randint(0, 255), rng.randint(1, 254)),
+        'ports': [rng.randint(31000, 32000) for _ in app['ports']],
+        'state': 'TASK_RUNNING',
+        'stagedAt': now,
+        'startedAt': now,
+        'version': app['version'],
+        'healthCheckResults': [
+            {'alive': True, 'consecutiveFailures': 0, 'firstSuccess': now,
+             'lastFailure': None, 'lastSuccess': now, 'taskId': taskId}
+            for _ in app['healthChecks']
+        ]
+    }
+
+
+def generate_app(index, tasks, ports, partition, rng):
+    """Create an app with F5 labels, health checks and running tasks.
+
+    Args:
+        index: Index of the app in the cluster, used for its ID and ports
+        tasks: Number of tasks
+        ports: Number of service ports
+        partition: Value of the F5_PARTITION label; None leaves the app
+                   unlabeled
+        rng: random.Random used for the generated data
+    """
+    labels = {}
+    if partition is not None:
+        labels['F5_PARTITION'] = partition
+        for i in range(ports):
+            labels['F5_%d_BIND_ADDR' % i] = '10.128.%d.%d' % (
+                index // 250 % 256, index % 250 + 1)
+            labels['F5_%d_PORT' % i] = str(8000 + i)
+            labels['F5_%d_MODE' % i] = rng.choice(['http', 'tcp'])
+            labels['F5_%d_BALANCE' % i] = 'round-robin'
+
+    app = {
+        'id': '/group-%d/app-%d' % (index // 100, index),
+        'instances': tasks,
+        'labels': labels,
+        'ports': [10000 + index * ports + i for i in range(ports)],
+        'healthChecks': [
+            {'protocol': 'HTTP', 'path': '/', 'portIndex': i,
+             'gracePeriodSeconds': 5, 'intervalSeconds': 20,
+             'timeoutSeconds': 20, 'maxConsecutiveFailures': 3}
+            for i in range(ports)
+        ],
+        'version': timestamp(),
+        'tasksRunning': tasks,
+        'tasksHealthy': tasks,
+        'tasksUnhealthy': 0,
+        'tasksStaged': 0,
+        'tasks': []
+    }
+    app['versionInfo'] = {'lastConfigChangeAt': app['version'],
+                          'lastScalingAt': app['version']}
+    app['tasks'] = [generate_task(app, rng) for _ in range(tasks)]
+    return app
+
+
+def generate_cluster(apps, tasks, ports, partitions=('mesos',),
+                     unmanaged=0.0, seed=None):
+    """Create the apps of a synthetic Marathon cluster.
+
+    Args:
+        apps: Number of apps
+        tasks: Number of tasks per app
+        ports: Number of service ports per app
+        partitions: F5_PARTITION values, assigned round-robin
+        unmanaged: Fraction of the apps without F5 labels
+        seed: Seed for reproducible data
+    """
+    rng = random.Random(seed)
+    cluster = []
+    for index in range(apps):
+        partition = partitions[index % len(partitions)]
+        if rng.random() < unmanaged:
+            partition = None
+        cluster.append(generate_app(index, tasks, ports, partition, rng))
+    return cluster
+
+
+class FakeCluster(object):
+    """State of a fake Marathon cluster shared by its FakeMarathon servers.
+
+    Every change is published to the open event streams as the events that
+    Marathon would send.
+    """
+
+    def __init__(self, apps, seed=None):
+        """Initialize the cluster with apps from generate_cluster()."""
+        self.lock = threading.Lock()
+        self.apps = OrderedDict((app['id'], app) for app in apps)
+        self.leader = None
+        self.events_published = 0
+        self.__rng = random.Random(seed)
+        self.__subscribers = []
+
+    def subscribe(self):
+        """Open an event stream; returns the queue the events are put on."""
+        events = Queue.Queue()
+        with self.lock:
+            self.__subscribers.append(events)
+        events.put({'eventType': 'event_stream_attached',
+                    'remoteAddress': '127.0.0.1', 'timestamp': timestamp()})
+        return events
+
+    def unsubscribe(self, events):
+        """Close an event stream."""
+        with self.lock:
+            if events in self.__subscribers:
+                self.__subscribers.remove(events)
+
+    def __publish(self, event):
+        """Send an event to all streams (lock must be held)."""
+        event.setdefault('timestamp', timestamp())
+        self.events_published += 1
+        for events in self.__subscribers:
+            events.put(event)
+
+    def __disconnect(self):
+        """Close all event streams (lock must be held)."""
+        for events in self.__subscribers:
+            events.put(None)
+        self.__subscribers = []
+
+    def __task_event(self, app, task, status):
+        """Publish the events for a task status change (lock held)."""
+        self.__publish({
+            'eventType': 'status_update_event',
+            'slaveId': 'agent-' + task['host'],
+            'taskId': task['id'],
+            'taskStatus': status,
+            'message': '',
+            'appId': app['id'],
+            'host': task['host'],
+            'ipAddresses': [{'ipAddress': task['host'],
+                             'protocol': 'IPv4'}],
+            'ports': task['ports'],
+            'version': task['version']
+        })
+        appName, _, taskUUID = task['id'].rpartition('.')
+        self.__publish({
+            'eventType': 'instance_changed_event',
+            'instanceId': '%s.marathon-%s' % (appName, taskUUID),
+            'condition': 'Running' if status == 'TASK_RUNNING' else 'Killed',
+            'runSpecId': app['id'],
+            'agentId': 'agent-' + task['host'],
+            'host': task['host'],
+            'runSpecVersion': task['version']
+        })
+
+    def __app_posted(self, app):
+        """Publish the API event for an app definition change (lock held)."""
+        definition = dict((k, v) for k, v in app.iteritems() if k != 'tasks')
+        self.__publish({'eventType': 'api_post_event',
+                        'clientIp': '127.0.0.1',
+                        'uri': '/v2/apps' + app['id'],
+                        'appDefinition': definition})
+
+    def random_app(self):
+        """Get the ID of a random app, or None if there are no apps."""
+        with self.lock:
+            if not self.apps:
+                return None
+            return self.__rng.choice(list(self.apps.keys()))
+
+    def random_task(self):
+        """Get the ID of a random task, or None if there are no tasks."""
+        with self.lock:
+            tasks = [task['id'] for app in self.apps.itervalues()
+                     for task in app['tasks']]
+            if not tasks:
+                return None
+            return self.__rng.choice(tasks)
+
+    def scale(self, appId, instances):
+        """Scale an app up or down to a number of instances."""
+        with self.lock:
+            app = self.apps[appId]
+            app['instances'] = instances
+            self.__app_posted(app)
+            while len(app['tasks']) < instances:
+                task = generate_task(app, self.__rng)
+                app['tasks'].append(task)
+                self.__task_event(app, task, 'TASK_RUNNING')
+            while len(app['tasks']) > instances:
+                self.__task_event(app, app['tasks'].pop(), 'TASK_KILLED')
+            app['tasksRunning'] = app['tasksHealthy'] = len(app['tasks'])
+
+    def kill_task(self, taskId, status='TASK_KILLED'):
+        """Kill a task; Marathon replaces it with a new one."""
+        with self.lock:
+            for app in self.apps.itervalues():
+                for task in app['tasks']:
+                    if task['id'] == taskId:
+                        app['tasks'].remove(task)
+                        self.__task_event(app, task, status)
+                        replacement = generate_task(app, self.__rng)
+                        app['tasks'].append(replacement)
+                        self.__task_event(app, replacement, 'TASK_RUNNING')
+                        return
+            raise KeyError(taskId)
+
+    def set_health(self, taskId, alive):
+        """Change the health check result of a task."""
+        with self.lock:
+            for app in self.apps.itervalues():
+                for task in app['tasks']:
+                    if task['id'] == taskId:
+                        for result in task['healthCheckResults']:
+                            result['alive'] = alive
+                        self.__publish({
+                            'eventType': 'health_status_changed_event',
+                            'appId': app['id'],
+                            'taskId': taskId,
+                            'version': task['version'],
+                            'alive': alive})
+                        return
+            raise KeyError(taskId)
+
+    def deploy(self, appId, labels=None):
+        """Deploy a new version of an app, replacing all of its tasks.
+
+        Args:
+            appId: ID of the app
+            labels: If set, labels to update in the new version
+        """
+        with self.lock:
+            app = self.apps[appId]
+            app['version'] = timestamp()
+            app['versionInfo']['lastConfigChangeAt'] = app['version']
+            if labels is not None:
+                app['labels'].update(labels)
+            self.__app_posted(app)
+            old_tasks = app['tasks']
+            app['tasks'] = []
+            for task in old_tasks:
+                replacement = generate_task(app, self.__rng)
+                app['tasks'].append(replacement)
+                self.__task_event(app, replacement, 'TASK_RUNNING')
+                self.__task_event(app, task, 'TASK_KILLED')
+            self.__publish({'eventType': 'deployment_success',
+                            'id': str(uuid.uuid4())})
+
+    def destroy(self, appId):
+        """Remove an app and its tasks."""
+        with self.lock:
+            app = self.apps.pop(appId)
+            for task in app['tasks']:
+                self.__task_event(app, task, 'TASK_KILLED')
+            self.__publish({'eventType': 'app_terminated_event',
+                            'appId': appId})
+
+    def set_leader(self, leader):
+        """Change the leading Marathon; the event streams are closed."""
+        with self.lock:
+            self.leader = leader
+            self.__disconnect()
+
+    def close(self):
+        """Close all event streams."""
+        with self.lock:
+            self.__disconnect()
+
+
+class FakeMarathonHandler(BaseHTTPRequestHandler):
+    """Serve the Marathon API from the server's FakeCluster."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        """Don't log each request."""
+        pass
+
+    def send_json(self, status, data):
+        """Send a JSON response."""
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        """Check the request credentials, if the server requires them."""
+        server = self.server
+        if server.username is None and server.token is None:
+            return True
+        header = self.headers.getheader('Authorization', '')
+        if server.token is not None and header == 'token=' + server.token:
+            return True
+        if server.username is not None and header.startswith('Basic '):
+            credentials = base64.b64decode(header[len('Basic '):])
+            return credentials == '%s:%s' % (server.username,
+                                             server.password)
+        return False
+
+    def do_GET(self):
+        """Handle a GET request."""
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        cluster = self.server.cluster
+        if url.path == '/ping':
+            self.send_response(200)
+            self.send_header('Content-Length', '4')
+            self.end_headers()
+            self.wfile.write('pong')
+            return
+        if not self.authorized():
+            self.send_json(401, {'message': 'Unauthorized'})
+            return
+
+        if url.path == '/v2/leader':
+            self.send_json(200, {'leader': cluster.leader or
+                                 self.server.endpoint})
+        elif url.path == '/v2/apps':
+            self.get_apps(cluster, query)
+        elif url.path.startswith('/v2/apps/'):
+            appId = url.path[len('/v2/apps'):].rstrip('/')
+            with cluster.lock:
+                app = cluster.apps.get(appId)
+                if app is not None:
+                    app = json.loads(json.dumps(app))
+            if app is None:
+                self.send_json(404, {'message': "App '%s' does not exist" %
+                                     appId})
+                return
+            if 'app.tasks' not in query.get('embed', []):
+                del app['tasks']
+            self.send_json(200, {'app': app})
+        elif url.path == '/v2/events':
+            self.stream_events(cluster)
+        else:
+            self.send_json(404, {'message': 'Not found'})
+
+    def get_apps(self, cluster, query):
+        """Send the app list, filtered by the label selector."""
+        selector = query.get('label', [None])[0]
+        with_tasks = 'apps.tasks' in query.get('embed', [])
+        try:
+            with cluster.lock:
+                apps = [app for app in cluster.apps.itervalues()
+                        if selector is None or
+                        match_label_selector(app['labels'], selector)]
+                body = json.dumps({'apps': [
+                    app if with_tasks else
+                    dict((k, v) for k, v in app.iteritems() if k != 'tasks')
+                    for app in apps]})
+        except ValueError as e:
+            self.send_json(422, {'message': str(e)})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_events(self, cluster):
+        """Stream the cluster events until the stream is closed."""
+        events = cluster.subscribe()
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            while not self.server.stopped:
+                try:
+                    event = events.get(timeout=self.server.keepalive)
+                except Queue.Empty:
+                    self.wfile.write('\r\n')
+                    self.wfile.flush()
+                    continue
+                if event is None:
+                    break
+                self.wfile.write('event: %s\r\ndata: %s\r\n\r\n' % (
+                    event['eventType'], json.dumps(event)))
+                self.wfile.flush()
+        except IOError:
+            # Client went away
+            pass
+        finally:
+            cluster.unsubscribe(events)
+
+
+class FakeMarathon(ThreadingMixIn, HTTPServer):
+    """HTTP server for a FakeCluster, standing in for one Marathon host."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cluster, host='127.0.0.1', port=0, username=None,
+                 password=None, token=None, keepalive=1.0):
+        """Initialize the server; port 0 picks a free port.
+
+        Args:
+            cluster: FakeCluster to serve
+            username, password: If set, require HTTP basic auth
+            token: If set, require a DC/OS 'token=...' Authorization header
+            keepalive: Interval (in seconds) of the event stream keepalives
+        """
+        HTTPServer.__init__(self, (host, port), FakeMarathonHandler)
+        self.cluster = cluster
+        self.username = username
+        self.password = password
+        self.token = token
+        self.keepalive = keepalive
+        self.stopped = False
+        self.__thread = None
+
+    @property
+    def endpoint(self):
+        """Get the host:port of the server, as reported by /v2/leader."""
+        return '%s:%d' % self.server_address
+
+    @property
+    def url(self):
+        """Get the URL of the server."""
+        return 'http://' + self.endpoint
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self.__thread = threading.Thread(target=self.serve_forever,
+                                         kwargs={'poll_interval': 0.1})
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """Stop serving requests and close the event streams."""
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
+        self.cluster.close()
+
+
+class ScenarioDriver(object):
+    """Change a FakeCluster at random at configurable rates.
+
+    The rates are the average number of changes per second of each kind:
+    'scale' (up or down by one instance), 'kill', 'deploy', 'health' and
+    'leader' (moving the leader among the servers).
+    """
+
+    def __init__(self, cluster, rates, servers=(), max_instances=None,
+                 seed=None):
+        """Initialize the driver; call start() to run it."""
+        self.cluster = cluster
+        self.rates = dict((k, v) for k, v in rates.iteritems() if v > 0)
+        self.servers = list(servers)
+        self.max_instances = max_instances
+        self.changes = dict((k, 0) for k in self.rates)
+        self.__rng = random.Random(seed)
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        """Run the scenario in a background thread."""
+        self.__thread = threading.Thread(target=self.run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """Stop the scenario."""
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def run(self):
+        """Make changes until stopped, as a Poisson process per kind."""
+        total = sum(self.rates.values())
+        if total == 0:
+            return
+        kinds = sorted(self.rates)
+        while not self.__stopped.wait(self.__rng.expovariate(total)):
+            pick = self.__rng.uniform(0, total)
+            for kind in kinds:
+                pick -= self.rates[kind]
+                if pick <= 0:
+                    break
+            try:
+                self.change(kind)
+            except KeyError:
+                # App or task went away in the meantime
+                continue
+            self.changes[kind] += 1
+
+    def change(self, kind):
+        """Make a single change of a kind."""
+        if kind == 'leader':
+            if self.servers:
+                self.cluster.set_leader(
+                    self.__rng.choice(self.servers).endpoint)
+            return
+
+        if kind == 'kill' or kind == 'health':
+            taskId = self.cluster.random_task()
+            if taskId is None:
+                return
+            if kind == 'kill':
+                self.cluster.kill_task(taskId)
+            else:
+                self.cluster.set_health(taskId, self.__rng.random() < 0.5)
+            return
+
+        appId = self.cluster.random_app()
+        if appId is None:
+            return
+        if kind == 'deploy':
+            self.cluster.deploy(appId)
+        elif kind == 'scale':
+            with self.cluster.lock:
+                instances = len(self.cluster.apps[appId]['tasks'])
+            if instances == 0 or self.__rng.random() < 0.5 and (
+                    self.max_instances is None or
+                    instances < self.max_instances):
+                instances += 1
+            else:
+                instances -= 1
+            self.cluster.scale(appId, instances)
+
+
+def main():
+    """Run fake Marathon servers for a synthetic cluster."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--apps', type=int, default=100)
+    parser.add_argument('--tasks', type=int, default=10,
+                        help='Number of tasks per app')
+    parser.add_argument('--ports', type=int, default=1,
+                        help='Number of service ports per app')
+    parser.add_argument('--partition', action='append',
+                        help='F5_PARTITION label values (default: mesos)')
+    parser.add_argument('--unmanaged', type=float, default=0.0,
+                        help='Fraction of the apps without F5 labels')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port of the first server')
+    parser.add_argument('--servers', type=int, default=1,
+                        help='Number of Marathon servers')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--token')
+    parser.add_argument('--seed', type=int)
+    for kind in ['scale', 'kill', 'deploy', 'health', 'leader']:
+        parser.add_argument('--%s-rate' % kind, type=float, default=0.0,
+                            help='Number of %s changes per second' % kind)
+    args = parser.parse_args()
+
+    start = time.time()
+    cluster = FakeCluster(
+        generate_cluster(args.apps, args.tasks, args.ports,
+                         args.partition or ['mesos'], args.unmanaged,
+                         args.seed), args.seed)
+    print("generated %d apps, %d tasks in %.1fs" % (
+        args.apps, args.apps * args.tasks, time.time() - start))
+
+    servers = []
+    for i in range(args.servers):
+        server = FakeMarathon(cluster, args.host, args.port + i,
+                              args.username, args.password, args.token)
+        server.start()
+        servers.append(server)
+        print("serving Marathon at %s" % server.url)
+    cluster.set_leader(servers[0].endpoint)
+
+    rates = dict((kind, getattr(args, '%s_rate' % kind))
+                 for kind in ['scale', 'kill', 'deploy', 'health', 'leader'])
+    driver = ScenarioDriver(cluster, rates, servers, seed=args.seed)
+    driver.start()
+    try:
+        while True:
+            time.sleep(10)
+            print("changes: %s, events: %d" % (driver.changes,
+                                               cluster.events_published))
+    except KeyboardInterrupt:
+        driver.stop()
+        for server in servers:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -28,15 +28,24 @@ import copy
 import time
 from sseclient import Event
 from mock import Mock, mock_open, patch
-from common import DCOSAuth, get_marathon_auth_params, setup_logging
+from common import (DCOSAuth, get_marathon_auth_params, setup_logging,
+                    JSONArrayStream, get_json_backends, json_backend_name,
+                    json_loads, json_dumps, LatencyTracker)
 from f5_cccl.utils.mgmt import ManagementRoot
 from f5_cccl.utils.mgmt import mgmt_root
 from f5_cccl.api import F5CloudServiceManager
 from f5_cccl.exceptions import F5CcclValidationError
 from f5_cccl.exceptions import F5CcclSchemaError
 from StringIO import StringIO
+from io import BytesIO
+from tests.fake_marathon import (FakeCluster, FakeMarathon, ScenarioDriver,
+                                 generate_cluster, match_label_selector)
 ctlr = __import__('marathon-bigip-ctlr')
 
+# The tests below mock requests.Session.request; keep the real one for the
+# tests that talk to the fake Marathon server
+session_request = requests.Session.request
+
 # Marathon app data
 marathon_test_data = [
     'tests/marathon_one_app_in_subdir.json',
@@ -69,7 +78,14 @@ args_env = ['F5_CC_SYSLOG_SOCKET',
             'F5_CC_SSE_TIMEOUT',
             'F5_CC_MARATHON_CA_CERT',
             'F5_CC_DCOS_AUTH_CREDENTIALS',
-            'F5_CC_DCOS_AUTH_TOKEN']
+            'F5_CC_DCOS_AUTH_TOKEN',
+            'F5_CC_MARATHON_POOL_SIZE',
+            'F5_CC_MARATHON_RETRIES',
+            'F5_CC_MARATHON_RETRY_BACKOFF',
+            'F5_CC_MARATHON_STREAM_APPS',
+            'F5_CC_MARATHON_PROBE_INTERVAL',
+            'F5_CC_MARATHON_TIMEOUT',
+            'F5_CC_MARATHON_HEDGE_PERCENTILE']
 
 
 version_data = {'version': '1.1.0', 'build': 'abcdef'}
@@ -108,20 +124,42 @@ class ArgTest(unittest.TestCase):
 
         expected = \
             "usage: marathon-bigip-ctlr.py [-h] [--longhelp]\n" \
-            """                              [--marathon MARATHON [MARATHON ...]]
-                              [--hostname HOSTNAME] [--username USERNAME]
-                              [--password PASSWORD] [--partition PARTITION]
-                              [--health-check]
-                              [--marathon-ca-cert MARATHON_CA_CERT]
-                              [--sse-timeout SSE_TIMEOUT]
-                              [--verify-interval VERIFY_INTERVAL] [--version]
-                              [--log-format LOG_FORMAT]
-                              [--log-level LOG_LEVEL]
-                              [--marathon-auth-credential-file""" \
-        """ MARATHON_AUTH_CREDENTIAL_FILE]\n \
-                             [--dcos-auth-credentials DCOS_AUTH_CREDENTIALS]
-                              [--dcos-auth-token DCOS_AUTH_TOKEN]\n""" \
-        "marathon-bigip-ctlr.py: error: argument --marathon/-m is required\n"
+            "                              [--marathon MARATHON [MARATHON" \
+            " ...]]\n" \
+            "                              [--hostname HOSTNAME] [--username" \
+            " USERNAME]\n" \
+            "                              [--password PASSWORD]" \
+            " [--partition PARTITION]\n" \
+            "                              [--health-check]\n" \
+            "                              [--marathon-ca-cert" \
+            " MARATHON_CA_CERT]\n" \
+            "                              [--sse-timeout SSE_TIMEOUT]\n" \
+            "                              [--verify-interval" \
+            " VERIFY_INTERVAL]\n" \
+            "                              [--marathon-pool-size" \
+            " MARATHON_POOL_SIZE]\n" \
+            "                              [--marathon-retries" \
+            " MARATHON_RETRIES]\n" \
+            "                              [--marathon-retry-backoff" \
+            " MARATHON_RETRY_BACKOFF]\n" \
+            "                              [--marathon-stream-apps]\n" \
+            "                              [--marathon-probe-interval" \
+            " MARATHON_PROBE_INTERVAL]\n" \
+            "                              [--marathon-timeout" \
+            " MARATHON_TIMEOUT]\n" \
+            "                              [--marathon-hedge-percentile" \
+            " MARATHON_HEDGE_PERCENTILE]\n" \
+            "                              [--version] [--log-format" \
+            " LOG_FORMAT]\n" \
+            "                              [--log-level LOG_LEVEL]\n" \
+            "                              [--marathon-auth-credential-file" \
+            " MARATHON_AUTH_CREDENTIAL_FILE]\n" \
+            "                              [--dcos-auth-credentials" \
+            " DCOS_AUTH_CREDENTIALS]\n" \
+            "                              [--dcos-auth-token" \
+            " DCOS_AUTH_TOKEN]\n" \
+            "marathon-bigip-ctlr.py: error: argument --marathon/-m is" \
+            " required\n"
 
         output = self.out.getvalue()
         self.assertEqual(output, expected)
@@ -579,17 +617,21 @@ class ArgTest(unittest.TestCase):
         r.status_code = 200
         return r
 
-    def request_response_failed(self):
+    def request_response_failed(self, data=None):
         """Mock a failed response."""
         r = requests.Response()
         r.status_code = 404
         r.reason = 'not found'
+        if data is not None:
+            r._content = json.dumps(data)
         return r
 
-    def request_response_ok(self):
+    def request_response_ok(self, data=None):
         """Mock an OK response."""
         r = requests.Response()
         r.status_code = 200
+        if data is not None:
+            r._content = json.dumps(data)
         return r
 
     def test_marathon_client(self):
@@ -614,32 +656,204 @@ class ArgTest(unittest.TestCase):
         self.assertEqual(marathon.host, 'http://10.0.0.10:8080')
         self.assertEqual(marathon.host, 'http://10.0.0.10:8081')
 
-        requests.Response.json = \
-            Mock(return_value={"apps": [], "message": "this will go wrong"})
         self.assertFalse(marathon.health_check())
 
         # HTTPError raise
-        requests.request = Mock(return_value=self.request_response_failed())
+        requests.Session.request = \
+            Mock(return_value=self.request_response_failed())
         self.assertRaises(requests.HTTPError, marathon.list)
 
+        # Marathon's error message is added to the reason
+        requests.Session.request = Mock(
+            return_value=self.request_response_failed(
+                {"apps": [], "message": "this will go wrong"}))
+        with self.assertRaises(requests.HTTPError) as cm:
+            marathon.list()
+        self.assertIn('not found (this will go wrong)', str(cm.exception))
+
         sys.argv[0:] = self._args_app_name + self._args_mandatory
         args = ctlr.parse_args(version_data)
         marathon = ctlr.Marathon(args.marathon,
                                  args.health_check,
                                  get_marathon_auth_params(args),
                                  args.marathon_ca_cert)
-        requests.Response.json = Mock(return_value={"apps": ['app1', 'app2'],
-                                      "message": "this is ok"})
         # Valid response and data
-        requests.request = Mock(return_value=self.request_response_ok())
+        requests.Session.request = Mock(
+            return_value=self.request_response_ok(
+                {"apps": ['app1', 'app2'], "message": "this is ok"}))
         self.assertTrue(marathon.list() == ['app1', 'app2'])
 
         # 'apps' key error
-        requests.Response.json = \
-            Mock(return_value={"no apps": ['app1', 'app2']})
-        requests.request = Mock(return_value=self.request_response_ok())
+        requests.Session.request = Mock(
+            return_value=self.request_response_ok(
+                {"no apps": ['app1', 'app2']}))
         self.assertRaises(KeyError, marathon.list)
 
+    def test_marathon_get_app(self):
+        """Test: Fetch a single app."""
+        marathon = ctlr.Marathon(['http://10.0.0.10:8080'], False, None)
+        app = {'id': '/group/app1', 'tasks': []}
+        requests.Session.request = \
+            Mock(return_value=self.request_response_ok({'app': app}))
+        self.assertEqual(marathon.get_app('/group/app1'), app)
+        args, kwargs = requests.Session.request.call_args
+        self.assertEqual(args[1], 'http://10.0.0.10:8080/v2/apps/group/app1')
+        self.assertEqual(kwargs['params'], {'embed': 'app.tasks'})
+
+        # App doesn't exist
+        requests.Session.request = \
+            Mock(return_value=self.request_response_failed())
+        self.assertEqual(marathon.get_app('/group/app1'), None)
+
+    def test_marathon_label_selector(self):
+        """Test: Only list the apps in the managed partitions."""
+        self.assertEqual(ctlr.label_selector(None), 'F5_PARTITION')
+        self.assertEqual(ctlr.label_selector(['mesos', 'test-1']),
+                         'F5_PARTITION in (mesos, test-1)')
+        self.assertEqual(ctlr.label_selector(['a b', 'c,d']),
+                         'F5_PARTITION in (a\\ b, c\\,d)')
+
+        marathon = ctlr.Marathon(['http://10.0.0.10:8080'], False, None,
+                                 partitions=['mesos'])
+        requests.Session.request = \
+            Mock(return_value=self.request_response_ok({'apps': []}))
+        self.assertEqual(marathon.list(), [])
+        args, kwargs = requests.Session.request.call_args
+        self.assertEqual(kwargs['params'],
+                         {'embed': 'apps.tasks',
+                          'label': 'F5_PARTITION in (mesos)'})
+
+        # No selector if the partitions are not known
+        marathon = ctlr.Marathon(['http://10.0.0.10:8080'], False, None)
+        self.assertEqual(marathon.list_params(), {'embed': 'apps.tasks'})
+
+    def test_marathon_stream_apps(self):
+        """Test: Stream the Marathon app list."""
+        with open('tests/marathon_two_apps.json') as json_data:
+            apps = json.load(json_data)
+
+        r = requests.Response()
+        r.status_code = 200
+        r.raw = BytesIO(json.dumps({'apps': apps}))
+        requests.Session.request = Mock(return_value=r)
+
+        marathon = ctlr.Marathon(['http://10.0.0.10:8080'], False, None,
+                                 stream_apps=True)
+        self.assertEqual(list(marathon.list()), apps)
+        self.assertTrue(r.raw.closed)
+
+        # Streamed apps produce the same services
+        r.raw = BytesIO(json.dumps({'apps': apps}))
+        services = ctlr.get_apps(marathon.list(), True)
+        self.assertEqual([repr(s) for s in services],
+                         [repr(s) for s in ctlr.get_apps(apps, True)])
+
+    def test_marathon_probe_interval_arg(self):
+        """Test: 'Marathon probe interval' arg."""
+        sys.argv[0:] = self._args_app_name + self._args_mandatory
+        args = ctlr.parse_args(version_data)
+        self.assertEqual(args.marathon_probe_interval, 10)
+
+        sys.argv[0:] = self._args_app_name + self._args_mandatory \
+            + ['--marathon-probe-interval', '0']
+        args = ctlr.parse_args(version_data)
+        self.assertEqual(args.marathon_probe_interval, 0)
+
+        # test via env var
+        sys.argv[0:] = self._args_app_name + self._args_mandatory
+        os.environ['F5_CC_MARATHON_PROBE_INTERVAL'] = '5'
+        args = ctlr.parse_args(version_data)
+        self.assertEqual(args.marathon_probe_interval, 5)
+
+        # Invalid interval
+        sys.argv[0:] = self._args_app_name + self._args_mandatory \
+            + ['--marathon-probe-interval', '-1']
+        self.assertRaises(SystemExit, ctlr.parse_args, version_data)
+
+    def test_marathon_deadline_args(self):
+        """Test: Marathon request deadline and hedging args."""
+        sys.argv[0:] = self._args_app_name + self._args_mandatory
+        args = ctlr.parse_args(version_data)
+        self.assertEqual(args.marathon_timeout, 30)
+        self.assertEqual(args.marathon_hedge_percentile, 0)
+
+        sys.argv[0:] = self._args_app_name + self._args_mandatory \
+            + ['--marathon-timeout', '2.5',
+               '--marathon-hedge-percentile', '95']
+        args = ctlr.parse_args(version_data)
+        self.assertEqual(args.marathon_timeout, 2.5)
+        self.assertEqual(args.marathon_hedge_percentile, 95)
+
+        # test via env var
+        sys.argv[0:] = self._args_app_name + self._args_mandatory
+        os.environ['F5_CC_MARATHON_TIMEOUT'] = '10'
+        os.environ['F5_CC_MARATHON_HEDGE_PERCENTILE'] = '90'
+        args = ctlr.parse_args(version_data)
+        self.assertEqual(args.marathon_timeout, 10)
+        self.assertEqual(args.marathon_hedge_percentile, 90)
+
+        # Invalid values
+        sys.argv[0:] = self._args_app_name + self._args_mandatory \
+            + ['--marathon-timeout', '0']
+        self.assertRaises(SystemExit, ctlr.parse_args, version_data)
+        sys.argv[0:] = self._args_app_name + self._args_mandatory \
+            + ['--marathon-hedge-percentile', '100']
+        self.assertRaises(SystemExit, ctlr.parse_args, version_data)
+
+    def test_marathon_pool_args(self):
+        """Test: Marathon connection pool args."""
+        sys.argv[0:] = self._args_app_name + self._args_mandatory
+        args = ctlr.parse_args(version_data)
+        self.assertEqual(args.marathon_pool_size, 10)
+        self.assertEqual(args.marathon_retries, 3)
+        self.assertEqual(args.marathon_retry_backoff, 0.1)
+
+        sys.argv[0:] = self._args_app_name + self._args_mandatory \
+            + ['--marathon-pool-size', '4', '--marathon-retries', '0',
+               '--marathon-retry-backoff', '0.5']
+        args = ctlr.parse_args(version_data)
+        self.assertEqual(args.marathon_pool_size, 4)
+        self.assertEqual(args.marathon_retries, 0)
+        self.assertEqual(args.marathon_retry_backoff, 0.5)
+
+        # test via env var
+        sys.argv[0:] = self._args_app_name + self._args_mandatory
+        os.environ['F5_CC_MARATHON_POOL_SIZE'] = '20'
+        os.environ['F5_CC_MARATHON_RETRIES'] = '5'
+        args = ctlr.parse_args(version_data)
+        self.assertEqual(args.marathon_pool_size, 20)
+        self.assertEqual(args.marathon_retries, 5)
+
+        # Invalid values
+        sys.argv[0:] = self._args_app_name + self._args_mandatory \
+            + ['--marathon-pool-size', '0']
+        self.assertRaises(SystemExit, ctlr.parse_args, version_data)
+        sys.argv[0:] = self._args_app_name + self._args_mandatory \
+            + ['--marathon-retries', '-1']
+        self.assertRaises(SystemExit, ctlr.parse_args, version_data)
+
+    def test_marathon_sessions(self):
+        """Test: Each Marathon host gets its own pooled session."""
+        hosts = ['http://10.0.0.10:8080', 'http://10.0.0.10:8081']
+        auth = DCOSAuth(None, None, 'token')
+        marathon = ctlr.Marathon(hosts, False, auth, pool_size=4,
+                                 max_retries=2)
+
+        session1 = marathon.session(hosts[0])
+        session2 = marathon.session(hosts[1])
+        self.assertIsNot(session1, session2)
+        self.assertIsNotNone(auth.session)
+        self.assertIsNot(auth.session, session1)
+        for prefix in ['http://', 'https://']:
+            adapter = session1.get_adapter(prefix + '10.0.0.10')
+            self.assertEqual(adapter._pool_maxsize, 4)
+            self.assertEqual(adapter.max_retries.total, 2)
+
+        stats = marathon.connection_stats()
+        self.assertEqual(sorted(stats.keys()), hosts)
+        self.assertEqual(stats[hosts[0]],
+                         {'requests': 0, 'connections': 0, 'reused': 0})
+
     def test_setup_logging(self):
         """Test logging set up."""
         sys.argv[0:] = self._args_app_name + self._args_mandatory \
@@ -1354,6 +1568,432 @@ class MarathonTest(unittest.TestCase):
                           cfg)
 
 
+class MarathonHostSelectorTest(unittest.TestCase):
+    """Test Marathon host probing and selection."""
+
+    hosts = ['http://10.0.0.10:8080', 'http://10.0.0.11:8080',
+             'http://10.0.0.12:8080']
+
+    def response(self, status_code, data=None):
+        """Mock a response."""
+        r = requests.Response()
+        r.status_code = status_code
+        r._content = json.dumps(data)
+        return r
+
+    def session(self, leader, fail=False, delay=0):
+        """Mock a session for a Marathon host."""
+        def get(url, **kwargs):
+            self.assertEqual(kwargs['timeout'],
+                             ctlr.MarathonHostSelector.probe_timeout)
+            if fail:
+                raise requests.exceptions.ConnectionError('down')
+            time.sleep(delay)
+            if url.endswith('/ping'):
+                return self.response(200)
+            return self.response(200, {'leader': leader})
+        session = Mock()
+        session.get = Mock(side_effect=get)
+        return session
+
+    def test_is_same_endpoint(self):
+        """Test: Match Marathon URLs against the leader."""
+        self.assertTrue(ctlr.is_same_endpoint('http://10.0.0.10:8080',
+                                              '10.0.0.10:8080'))
+        self.assertTrue(ctlr.is_same_endpoint('http://10.0.0.10',
+                                              '10.0.0.10:80'))
+        self.assertTrue(ctlr.is_same_endpoint('https://10.0.0.10/marathon',
+                                              '10.0.0.10:443'))
+        self.assertFalse(ctlr.is_same_endpoint('http://10.0.0.10:8080',
+                                               '10.0.0.11:8080'))
+        self.assertFalse(ctlr.is_same_endpoint('http://10.0.0.10:8080',
+                                               '10.0.0.10:8081'))
+        self.assertFalse(ctlr.is_same_endpoint('http://10.0.0.10:8080',
+                                               None))
+
+    def test_ranking(self):
+        """Test: Healthy leader first, then by latency, failed last."""
+        leader = '10.0.0.12:8080'
+        sessions = {
+            self.hosts[0]: self.session(leader, fail=True),
+            self.hosts[1]: self.session(leader, delay=0.05),
+            self.hosts[2]: self.session(leader, delay=0.1)
+        }
+        selector = ctlr.MarathonHostSelector(self.hosts, sessions, None,
+                                             False)
+        # Configured order before probing
+        self.assertEqual(selector.ranked(), self.hosts)
+
+        selector.probe_all()
+        self.assertEqual(selector.ranked(), [self.hosts[2], self.hosts[1],
+                                             self.hosts[0]])
+        states = selector.states()
+        self.assertFalse(states[self.hosts[0]]['healthy'])
+        self.assertIn('down', states[self.hosts[0]]['error'])
+        self.assertTrue(states[self.hosts[2]]['leader'])
+        self.assertGreater(states[self.hosts[2]]['latency'],
+                           states[self.hosts[1]]['latency'])
+
+        # A failed request demotes the leader until the next probe
+        selector.report_failure(self.hosts[2])
+        self.assertEqual(selector.ranked(), [self.hosts[1], self.hosts[0],
+                                             self.hosts[2]])
+        selector.probe_all()
+        self.assertEqual(selector.ranked()[0], self.hosts[2])
+
+    def test_marathon_failover(self):
+        """Test: Requests move on to the next host on connection errors."""
+        r = self.response(200, {'apps': []})
+        requests.Session.request = Mock(side_effect=[
+            requests.exceptions.ConnectionError('down'), r])
+        marathon = ctlr.Marathon(self.hosts[:2], False, None)
+        self.assertEqual(marathon.list(), [])
+        self.assertEqual(requests.Session.request.call_count, 2)
+
+        requests.Session.request = Mock(
+            side_effect=requests.exceptions.ConnectionError('down'))
+        self.assertRaises(requests.exceptions.ConnectionError, marathon.list)
+
+    def test_latency_tracker(self):
+        """Test: Latency percentiles over the recent samples."""
+        tracker = LatencyTracker(window=10, min_samples=5)
+        self.assertIsNone(tracker.percentile(50))
+        for i in range(1, 21):
+            tracker.record(i / 10.0)
+        self.assertEqual(len(tracker), 10)
+        self.assertEqual(tracker.percentile(50), 1.5)
+        self.assertEqual(tracker.percentile(90), 1.9)
+        self.assertEqual(tracker.percentile(100), 2.0)
+
+    def test_marathon_deadline(self):
+        """Test: Requests pass a timeout and stop at the deadline."""
+        def request(method, url, **kwargs):
+            connect, read = kwargs['timeout']
+            self.assertLessEqual(connect, ctlr.Marathon.connect_timeout)
+            self.assertLessEqual(read, 0.2)
+            time.sleep(0.15)
+            raise requests.exceptions.ReadTimeout('slow')
+        requests.Session.request = Mock(side_effect=request)
+        marathon = ctlr.Marathon(self.hosts, False, None, timeout=0.2)
+        self.assertRaises(requests.exceptions.Timeout, marathon.list)
+        # The third host is not tried once the deadline has passed
+        self.assertEqual(requests.Session.request.call_count, 2)
+
+    def test_marathon_hedging(self):
+        """Test: Slow requests are hedged to the next host."""
+        def request(method, url, **kwargs):
+            if url.startswith(self.hosts[0]) and slow[0]:
+                time.sleep(0.5)
+            return self.response(200, {'apps': []})
+        slow = [False]
+        requests.Session.request = Mock(side_effect=request)
+        marathon = ctlr.Marathon(self.hosts[:2], False, None,
+                                 hedge_percentile=90)
+        # Not enough samples yet; no hedging
+        for _ in range(10):
+            self.assertEqual(marathon.list(), [])
+        self.assertEqual(marathon.latency_stats()['hedged_requests'], 0)
+        self.assertEqual(marathon.latency_stats()['samples'], 10)
+
+        slow[0] = True
+        start = time.time()
+        self.assertEqual(marathon.list(), [])
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(marathon.latency_stats()['hedged_requests'], 1)
+
+
+class MarathonStateTest(unittest.TestCase):
+    """Test the in-memory Marathon app and task index."""
+
+    def setUp(self):
+        """Test suite set up."""
+        with open('tests/marathon_two_apps.json') as json_data:
+            self.cloud_data = json.load(json_data)
+        self.state = ctlr.MarathonState()
+        self.assertFalse(self.state.populated)
+        self.state.reset(copy.deepcopy(self.cloud_data))
+        self.assertTrue(self.state.populated)
+
+    def backends(self, appId):
+        """Get the sorted (host, port) backends of an app's services."""
+        apps = ctlr.get_apps(self.state.apps(), False)
+        return sorted((b.host, b.port) for app in apps
+                      if app.appId == appId for b in app.backends)
+
+    def status_update(self, taskId, status, ports, appId='/server-app'):
+        """Create a status_update_event."""
+        return {'eventType': 'status_update_event', 'appId': appId,
+                'taskId': taskId, 'taskStatus': status,
+                'host': '10.141.141.11', 'ports': ports}
+
+    def test_reset(self):
+        """Test: Services built from the state match the Marathon apps."""
+        expected = ctlr.get_apps(self.cloud_data, True)
+        apps = ctlr.get_apps(self.state.apps(), True)
+        self.assertEqual([repr(a) for a in apps],
+                         [repr(a) for a in expected])
+        self.assertEqual(
+            [sorted((b.host, b.port) for b in a.backends) for a in apps],
+            [sorted((b.host, b.port) for b in a.backends) for a in expected])
+
+    def test_status_update_event(self):
+        """Test: Tasks are added and removed by status_update_events."""
+        self.assertEqual(self.backends('/server-app'),
+                         [('10.141.141.10', 31972), ('10.141.141.10', 31982)])
+
+        # Scale up
+        self.assertTrue(self.state.apply_event(
+            self.status_update('server-app.new', 'TASK_RUNNING', [31000])))
+        self.assertEqual(self.backends('/server-app'),
+                         [('10.141.141.10', 31972), ('10.141.141.10', 31982),
+                          ('10.141.141.11', 31000)])
+
+        # Task killed
+        self.assertTrue(self.state.apply_event(self.status_update(
+            'server-app.d7a3a630-1d0f-11e6-b12b-02429f4f0fd6', 'TASK_KILLED',
+            [31972])))
+        self.assertEqual(self.backends('/server-app'),
+                         [('10.141.141.10', 31982), ('10.141.141.11', 31000)])
+
+        # Unknown app requires a full fetch
+        self.assertFalse(self.state.apply_event(self.status_update(
+            'new-app.1', 'TASK_RUNNING', [31001], appId='/new-app')))
+
+    def test_instance_changed_event(self):
+        """Test: Tasks of terminated instances are removed."""
+        event = {'eventType': 'instance_changed_event',
+                 'runSpecId': '/server-app2',
+                 'instanceId':
+                 'server-app2.marathon-daa24031-1d0f-11e6-b12b-02429f4f0fd6',
+                 'condition': 'Running'}
+        self.assertFalse(self.state.apply_event(event))
+        self.assertEqual(len(self.backends('/server-app2')), 4)
+
+        event['condition'] = 'Killed'
+        self.assertTrue(self.state.apply_event(event))
+        self.assertNotIn(('10.141.141.10', 31126),
+                         self.backends('/server-app2'))
+        self.assertEqual(len(self.backends('/server-app2')), 3)
+
+    def test_events_replayed_after_reset(self):
+        """Test: Events received during a full fetch are not lost."""
+        self.state.begin_reset()
+        self.state.apply_event(
+            self.status_update('server-app.new', 'TASK_RUNNING', [31000]))
+        # The fetched state predates the event
+        self.state.reset(copy.deepcopy(self.cloud_data))
+        self.assertIn(('10.141.141.11', 31000), self.backends('/server-app'))
+
+        # Events are no longer recorded after the reset
+        self.state.apply_event(
+            self.status_update('server-app.new', 'TASK_FAILED', [31000]))
+        self.state.reset(copy.deepcopy(self.cloud_data))
+        self.assertNotIn(('10.141.141.11', 31000),
+                         self.backends('/server-app'))
+
+    def test_app_events(self):
+        """Test: App definitions are updated and removed individually."""
+        app = copy.deepcopy(self.cloud_data[1])
+        del app['tasks']
+        app['labels']['F5_0_BIND_ADDR'] = '10.128.10.250'
+        self.assertTrue(self.state.update_app_definition(app))
+        apps = ctlr.get_apps(self.state.apps(), False)
+        service = [a for a in apps if a.appId == '/server-app'][0]
+        self.assertEqual(service.bindAddr, '10.128.10.250')
+        # Tasks are kept
+        self.assertEqual(len(service.backends), 2)
+
+        # Definitions without port data need a fetch
+        del app['ports']
+        self.assertFalse(self.state.update_app_definition(app))
+
+        # Unknown apps need a fetch
+        app = {'id': '/new-app', 'labels': {}, 'ports': [10003]}
+        self.assertFalse(self.state.update_app_definition(app))
+        app['tasks'] = [{'id': 'new-app.1', 'host': '10.141.141.11',
+                         'ports': [31001]}]
+        self.state.update_app('/new-app', app)
+        self.assertEqual(self.backends('/new-app'),
+                         [('10.141.141.11', 31001)])
+
+        self.assertTrue(self.state.remove_app('/new-app'))
+        self.assertFalse(self.state.remove_app('/new-app'))
+        self.assertEqual(self.backends('/new-app'), [])
+
+        # A fetched app of None means it no longer exists
+        self.state.update_app('/server-app2', None)
+        self.assertEqual(len(self.state.apps()), 2)
+
+    def test_event_processor_app_events(self):
+        """Test: App events fetch at most the affected app."""
+        with patch.object(ctlr.MarathonEventProcessor,
+                          'reset_from_tasks') as reset_from_tasks, \
+                patch.object(ctlr.MarathonEventProcessor,
+                             'reset_from_state') as reset_from_state, \
+                patch.object(ctlr.MarathonEventProcessor,
+                             'reset_from_app') as reset_from_app:
+            ep = ctlr.MarathonEventProcessor(Mock(), 100, [])
+            ep._MarathonEventProcessor__state.reset(
+                copy.deepcopy(self.cloud_data))
+            reset_from_tasks.reset_mock()
+
+            app = copy.deepcopy(self.cloud_data[1])
+            ep.handle_event({'eventType': 'api_post_event',
+                             'appDefinition': app})
+            self.assertEqual(reset_from_state.call_count, 1)
+
+            app['id'] = '/new-app'
+            ep.handle_event({'eventType': 'api_post_event',
+                             'appDefinition': app})
+            reset_from_app.assert_called_once_with('/new-app')
+
+            ep.handle_event({'eventType': 'app_terminated_event',
+                             'appId': '/server-app'})
+            self.assertEqual(reset_from_state.call_count, 2)
+            self.assertEqual(reset_from_tasks.call_count, 0)
+
+    def test_event_processor_task_events(self):
+        """Test: Task events are applied without a full fetch."""
+        with patch.object(ctlr.MarathonEventProcessor,
+                          'reset_from_tasks') as reset_from_tasks, \
+                patch.object(ctlr.MarathonEventProcessor,
+                             'reset_from_state') as reset_from_state, \
+                patch.object(ctlr.MarathonEventProcessor,
+                             'reset_from_app') as reset_from_app:
+            ep = ctlr.MarathonEventProcessor(Mock(), 100, [])
+            ep._MarathonEventProcessor__state.reset(
+                copy.deepcopy(self.cloud_data))
+            reset_from_tasks.reset_mock()
+
+            ep.handle_event(
+                self.status_update('server-app.new', 'TASK_RUNNING', [31000]))
+            self.assertEqual(reset_from_state.call_count, 1)
+            self.assertEqual(reset_from_tasks.call_count, 0)
+
+            ep.handle_event(self.status_update(
+                'new-app.1', 'TASK_RUNNING', [31001], appId='/new-app'))
+            self.assertEqual(reset_from_state.call_count, 1)
+            self.assertEqual(reset_from_tasks.call_count, 0)
+            reset_from_app.assert_called_once_with('/new-app')
+
+    def test_unmanaged_apps(self):
+        """Test: Apps outside the managed partitions are ignored."""
+        apps = copy.deepcopy(self.cloud_data)
+        apps[2]['labels']['F5_PARTITION'] = 'other'
+        self.assertEqual(
+            [a.appId for a in ctlr.get_apps(apps, False, ['mesos'])],
+            ['/server-app'])
+
+        # Unlabeled apps and apps in other partitions are not kept
+        state = ctlr.MarathonState(['mesos'])
+        state.reset(apps)
+        self.assertEqual([a['id'] for a in state.apps()], ['/server-app'])
+        self.assertTrue(state.is_ignored('/f5-service-router'))
+        self.assertTrue(state.is_ignored('/server-app2'))
+
+        # Moving into a managed partition
+        apps[2]['labels']['F5_PARTITION'] = 'mesos'
+        state.update_app('/server-app2', apps[2])
+        self.assertFalse(state.is_ignored('/server-app2'))
+        self.assertEqual(len(state.apps()), 2)
+
+        # Moving out of the managed partitions
+        self.assertTrue(state.ignore_app('/server-app2'))
+        self.assertTrue(state.is_ignored('/server-app2'))
+        self.assertEqual(len(state.apps()), 1)
+
+    def test_event_processor_unmanaged_apps(self):
+        """Test: Events of unmanaged apps don't fetch from Marathon."""
+        with patch.object(ctlr.MarathonEventProcessor,
+                          'reset_from_tasks') as reset_from_tasks, \
+                patch.object(ctlr.MarathonEventProcessor,
+                             'reset_from_state') as reset_from_state, \
+                patch.object(ctlr.MarathonEventProcessor,
+                             'reset_from_app') as reset_from_app:
+            ep = ctlr.MarathonEventProcessor(Mock(), 100, [], ['mesos'])
+            state = ep._MarathonEventProcessor__state
+            state.reset(copy.deepcopy(self.cloud_data))
+            reset_from_tasks.reset_mock()
+
+            # First task of an unknown app fetches it; it is unmanaged
+            event = self.status_update('other.1', 'TASK_RUNNING', [31001],
+                                       appId='/other')
+            ep.handle_event(event)
+            reset_from_app.assert_called_once_with('/other')
+            state.update_app('/other', {'id': '/other', 'tasks': [],
+                                        'labels': {}})
+            ep.handle_event(event)
+            self.assertEqual(reset_from_app.call_count, 1)
+
+            # Relabeled out of the managed partitions
+            app = copy.deepcopy(self.cloud_data[1])
+            app['labels']['F5_PARTITION'] = 'other'
+            ep.handle_event({'eventType': 'api_post_event',
+                             'appDefinition': app})
+            self.assertEqual(reset_from_state.call_count, 1)
+            self.assertTrue(state.is_ignored(app['id']))
+            self.assertEqual([a['id'] for a in state.apps()],
+                             ['/server-app2'])
+            self.assertEqual(reset_from_tasks.call_count, 0)
+
+
+class JSONCodecTest(unittest.TestCase):
+    """Test the JSON codec."""
+
+    def test_backends(self):
+        """Test: All installed backends decode the same data."""
+        backends = get_json_backends()
+        self.assertEqual(backends[-1][0], 'json')
+        self.assertEqual(json_backend_name, backends[0][0])
+
+        with open('tests/marathon_two_apps.json') as json_data:
+            raw = json_data.read()
+        expected = json.loads(raw)
+        for name, backend in backends:
+            self.assertEqual(backend.loads(raw), expected)
+        self.assertEqual(json_loads(raw), expected)
+        self.assertEqual(json_loads(json_dumps(expected)), expected)
+        self.assertRaises(ValueError, json_loads, '{"eventType": }')
+
+
+class JSONArrayStreamTest(unittest.TestCase):
+    """Test incremental decoding of JSON arrays."""
+
+    def chunks(self, data, size):
+        """Split data into chunks of the given size."""
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_decode_chunks(self):
+        """Test: Decode arrays split across arbitrary chunk boundaries."""
+        with open('tests/marathon_two_apps.json') as json_data:
+            apps = json.load(json_data)
+        data = json.dumps({'apps': apps}, indent=2)
+
+        for size in [1, 7, 100, len(data)]:
+            stream = JSONArrayStream(self.chunks(data, size), 'apps')
+            self.assertEqual(list(stream), apps)
+            self.assertEqual(stream.items_decoded, len(apps))
+            self.assertTrue(0 < stream.bytes_decoded <= len(data))
+
+        stream = JSONArrayStream(['{"apps": []}'], 'apps')
+        self.assertEqual(list(stream), [])
+
+        # Multi-byte characters split across chunks
+        data = json.dumps({'apps': [{'id': u'/\u00e9t\u00e9'}]},
+                          ensure_ascii=False).encode('utf-8')
+        stream = JSONArrayStream(self.chunks(data, 1), 'apps')
+        self.assertEqual(list(stream), [{'id': u'/\u00e9t\u00e9'}])
+
+    def test_decode_errors(self):
+        """Test: Missing or truncated arrays raise errors."""
+        stream = JSONArrayStream(['{"no apps": []}'], 'apps')
+        self.assertRaises(KeyError, list, stream)
+
+        stream = JSONArrayStream(['{"apps": [{"id": "/app1"}, {"id"'],
+                                 'apps')
+        self.assertRaises(ValueError, list, stream)
+
+
 class GetProtocolTest(unittest.TestCase):
     """Test marathon-bigip-ctlr get_protocol function."""
 
@@ -1461,3 +2101,106 @@ class IsLabelDataValidTest(unittest.TestCase):
 
 if __name__ == '__main__':
     unittest.main()
+
+
+class FakeMarathonTest(unittest.TestCase):
+    """Drive the Marathon client against the fake Marathon server."""
+
+    def setUp(self):
+        """Test suite set up."""
+        self.cluster = FakeCluster(
+            generate_cluster(20, 3, 2, partitions=['mesos', 'other'],
+                             seed=1), seed=1)
+        self.servers = [FakeMarathon(self.cluster, username='user',
+                                     password='pass', keepalive=0.1)
+                        for _ in range(2)]
+        for server in self.servers:
+            server.start()
+        self.cluster.set_leader(self.servers[1].endpoint)
+        self.patcher = patch.object(requests.Session, 'request',
+                                    session_request)
+        self.patcher.start()
+
+    def tearDown(self):
+        """Test suite tear down."""
+        self.patcher.stop()
+        for server in self.servers:
+            server.stop()
+
+    def test_match_label_selector(self):
+        """Test: Marathon label selectors."""
+        labels = {'F5_PARTITION': 'a b', 'MODE': 'http'}
+        self.assertTrue(match_label_selector(labels, 'F5_PARTITION'))
+        self.assertFalse(match_label_selector(labels, 'OTHER'))
+        self.assertTrue(match_label_selector(labels, 'MODE==http'))
+        self.assertFalse(match_label_selector(labels, 'MODE!=http'))
+        self.assertTrue(match_label_selector(
+            labels, ctlr.label_selector(['x', 'a b'])))
+        self.assertFalse(match_label_selector(
+            labels, 'F5_PARTITION in (x), MODE==http'))
+        self.assertTrue(match_label_selector(
+            labels, 'F5_PARTITION notin (x), MODE==http'))
+
+    def test_list_apps(self):
+        """Test: Fetch the managed apps from the fake server."""
+        marathon = ctlr.Marathon([s.url for s in self.servers], False,
+                                 ('user', 'pass'), partitions=['mesos'],
+                                 probe_interval=60)
+        marathon.probe_all()
+        self.assertEqual(marathon.hosts()[0], self.servers[1].url)
+
+        apps = marathon.list()
+        self.assertEqual(len(apps), 10)
+        self.assertEqual(set(a['labels']['F5_PARTITION'] for a in apps),
+                         set(['mesos']))
+        services = ctlr.get_apps(apps, True)
+        self.assertEqual(len(services), 20)
+        self.assertEqual(sum(len(s.backends) for s in services), 60)
+
+        app = marathon.get_app(apps[0]['id'])
+        self.assertEqual(app, apps[0])
+        self.assertIsNone(marathon.get_app('/missing'))
+
+        marathon = ctlr.Marathon([self.servers[0].url], False,
+                                 ('user', 'wrong'))
+        self.assertRaises(requests.exceptions.HTTPError, marathon.list)
+
+    def test_event_stream(self):
+        """Test: Events of the scripted changes are streamed."""
+        marathon = ctlr.Marathon([self.servers[0].url], False,
+                                 ('user', 'pass'))
+        events = iter(marathon.get_event_stream(5))
+        self.assertEqual(json.loads(next(events).data)['eventType'],
+                         'event_stream_attached')
+
+        taskId = self.cluster.random_task()
+        self.cluster.kill_task(taskId)
+        received = []
+        while len(received) < 4:
+            event = next(events)
+            if event.data.strip():
+                received.append(json.loads(event.data))
+        self.assertEqual(received[0]['eventType'], 'status_update_event')
+        self.assertEqual(received[0]['taskId'], taskId)
+        self.assertEqual(received[0]['taskStatus'], 'TASK_KILLED')
+        self.assertEqual(received[2]['taskStatus'], 'TASK_RUNNING')
+
+        # Leader changes close the stream
+        self.cluster.set_leader(self.servers[1].endpoint)
+        self.assertRaises(StopIteration, lambda: [e for e in events
+                                                  if not e.data.strip()])
+
+    def test_scenario_driver(self):
+        """Test: Scripted changes at configurable rates."""
+        tasks = sum(len(a['tasks']) for a in self.cluster.apps.values())
+        driver = ScenarioDriver(self.cluster, {'scale': 200, 'kill': 200,
+                                               'deploy': 0}, seed=1)
+        driver.start()
+        time.sleep(0.2)
+        driver.stop()
+        self.assertGreater(driver.changes['scale'], 0)
+        self.assertGreater(driver.changes['kill'], 0)
+        self.assertNotIn('deploy', driver.changes)
+        self.assertGreater(self.cluster.events_published, 0)
+        self.assertNotEqual(
+            sum(len(a['tasks']) for a in self.cluster.apps.values()), tasks)